@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+import hashlib
+import shutil
+
+import numpy as np
+
+
+def getCacheDir():
+    """
+    Directory for things we can always recompute, shared by all sims.
+    Set AOS_CACHE_DIR to move it, e.g. to a local disk.
+    """
+    aosSrcDir = os.path.split(os.path.abspath(__file__))[0]
+    return os.environ.get('AOS_CACHE_DIR', '%s/../cache' % aosSrcDir)
+
+
+def arrayKey(*args):
+    """sha1 hex digest of arrays (by value) and anything else (by repr)"""
+    h = hashlib.sha1()
+    for a in args:
+        if isinstance(a, np.ndarray):
+            if a.dtype == bool:
+                a = np.packbits(a)
+            h.update(str(a.shape).encode())
+            h.update(np.ascontiguousarray(a).tobytes())
+        else:
+            h.update(repr(a).encode())
+    return h.hexdigest()
+
+
+def saveCache(filename, **arrays):
+    """
+    np.savez, but written under a temporary name first and renamed,
+    so that other processes never read half a file.
+    """
+    cacheDir = os.path.dirname(filename)
+    if cacheDir and not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+    tmpFile = '%s.%d.tmp.npz' % (filename, os.getpid())
+    np.savez(tmpFile, **arrays)
+    os.replace(tmpFile, filename)
+
+
+def saveCacheArray(filename, a):
+    """
+    np.save of one array, written and renamed the same way as saveCache(),
+    for arrays that get memory-mapped with np.load(mmap_mode='r').
+    """
+    cacheDir = os.path.dirname(filename)
+    if cacheDir and not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+    tmpFile = '%s.%d.tmp.npy' % (filename, os.getpid())
+    np.save(tmpFile, a)
+    os.replace(tmpFile, filename)
+
+
+def loadtxtCached(filename, **kwargs):
+    """
+    np.loadtxt(filename, **kwargs), through a binary copy, filename.npz,
+    next to the text file (in getCacheDir() if that directory is
+    read-only). The copy keeps the sha1 of the text and kwargs, and gets
+    rebuilt whenever they change.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        h.update(fid.read())
+    h.update(repr(sorted(kwargs.items())).encode())
+    key = h.hexdigest()
+
+    filename = os.path.abspath(filename)
+    if os.access(os.path.dirname(filename), os.W_OK):
+        cacheFile = '%s.npz' % filename
+    else:
+        cacheFile = '%s/txt_%s.npz' % (
+            getCacheDir(), hashlib.sha1(filename.encode()).hexdigest())
+
+    if os.path.isfile(cacheFile):
+        try:
+            with np.load(cacheFile) as f:
+                if str(f['key']) == key:
+                    return f['data']
+        except (OSError, ValueError, KeyError):
+            pass  # a broken copy gets rewritten below
+    data = np.loadtxt(filename, **kwargs)
+    try:
+        saveCache(cacheFile, data=data, key=np.array(key))
+    except OSError:
+        pass  # still fine, just slower next time
+    return data
+
+
+class ArtifactCache(object):
+    """
+    Content-addressed store of generated files, e.g. the zlist and
+    residual surface maps from writePertFile(), in cacheDir/artifacts/key/.
+    Callers pick the key (e.g. arrayKey() of everything the files depend
+    on) and name the files; get() hard-links them (or copies, across file
+    systems) to where they are wanted. Once the store is larger than
+    maxBytes, the least recently used entries are removed.
+    cacheDir=None uses getCacheDir(); cacheDir='' turns the store off.
+    store names the subdirectory, for things that need a bound of their own.
+    """
+
+    def __init__(self, cacheDir=None, maxBytes=2 * 1024**3,
+                 store='artifacts'):
+        if cacheDir is None:
+            cacheDir = getCacheDir()
+        self.storeDir = '%s/%s' % (cacheDir, store) if cacheDir else ''
+        self.maxBytes = maxBytes
+
+    def getEntry(self, key, names):
+        """
+        the directory holding the files names of key, to be read in place
+        (e.g. memory-mapped), or None if they aren't all there
+        """
+        if not self.storeDir:
+            return None
+        entryDir = '%s/%s' % (self.storeDir, key)
+        if not all(os.path.isfile('%s/%s' % (entryDir, name))
+                   for name in names):
+            return None
+        try:
+            os.utime(entryDir)  # most recently used
+        except OSError:
+            return None  # evicted by another process meanwhile
+        return entryDir
+
+    def get(self, key, files):
+        """
+        files is {name: destination}. Returns True if key is in the store
+        and all its files are now at their destinations. Otherwise returns
+        False, after removing the destinations, which may be links into the
+        store, so that writing them anew leaves the store alone.
+        """
+        entryDir = '%s/%s' % (self.storeDir, key)
+        if not (self.storeDir and all(
+                os.path.isfile('%s/%s' % (entryDir, name))
+                for name in files)):
+            for dest in files.values():
+                if os.path.lexists(dest):
+                    os.remove(dest)
+            return False
+        try:
+            for name, dest in files.items():
+                linkOrCopy('%s/%s' % (entryDir, name), dest)
+            os.utime(entryDir)  # most recently used
+        except OSError:
+            # evicted by another process meanwhile; the caller makes them
+            for dest in files.values():
+                if os.path.lexists(dest):
+                    os.remove(dest)
+            return False
+        return True
+
+    def put(self, key, files):
+        """store copies of files, {name: path}, under key"""
+        if not self.storeDir:
+            return
+        entryDir = '%s/%s' % (self.storeDir, key)
+        if os.path.isdir(entryDir):
+            return
+        os.makedirs(self.storeDir, exist_ok=True)
+        tmpDir = '%s.%d.tmp' % (entryDir, os.getpid())
+        os.makedirs(tmpDir, exist_ok=True)
+        for name, path in files.items():
+            shutil.copyfile(path, '%s/%s' % (tmpDir, name))
+        try:
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            # another process stored the same key first
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.evict()
+
+    def getArrays(self, key):
+        """the arrays stored by putArrays(key), {name: array}, or None"""
+        if not self.storeDir:
+            return None
+        entryDir = '%s/%s' % (self.storeDir, key)
+        try:
+            with np.load('%s/arrays.npz' % entryDir) as aa:
+                arrays = {name: aa[name] for name in aa.files}
+            os.utime(entryDir)  # most recently used
+        except (OSError, ValueError):
+            return None  # not there, or evicted by someone else meanwhile
+        return arrays
+
+    def putArrays(self, key, **arrays):
+        """store arrays, as with np.savez, under key"""
+        if not self.storeDir:
+            return
+        os.makedirs(self.storeDir, exist_ok=True)
+        tmpFile = '%s/%s.%d.arrays.tmp' % (self.storeDir, key, os.getpid())
+        saveCache(tmpFile, **arrays)
+        self.put(key, {'arrays.npz': tmpFile})
+        os.remove(tmpFile)
+
+    def evict(self):
+        """remove the least recently used entries beyond maxBytes"""
+        entries = []
+        total = 0
+        for key in os.listdir(self.storeDir):
+            if key.endswith('.tmp'):
+                continue
+            entryDir = '%s/%s' % (self.storeDir, key)
+            try:
+                size = sum(os.path.getsize('%s/%s' % (entryDir, name))
+                           for name in os.listdir(entryDir))
+                entries.append((os.path.getmtime(entryDir), size, entryDir))
+            except OSError:
+                continue  # being written or removed by someone else
+            total += size
+        for _, size, entryDir in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            total -= size
+
+
+def linkOrCopy(src, dest):
+    """hard-link src to dest, replacing dest; copy if they can't be linked"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+
+import numpy as np
+
+from aosDataBundle import loadData
+
+# the tables in data/camera. RB: rigid body dx, dy, dz (mm), Rx, Ry, Rz
+# zer: surface Zernikes (mm)
+distTypes = ['L1RB', 'L2RB', 'FRB', 'L3RB', 'FPRB',
+             'L1S1zer', 'L2S1zer', 'L3S1zer', 'L1S2zer', 'L2S2zer', 'L3S2zer']
+
+# Andy's Zernike order is different, fix it
+zidx = [1, 3, 2, 5, 4, 6, 8, 9, 7, 10, 13, 14, 12, 15, 11, 19,
+        18, 20, 17, 21, 16, 25, 24, 26, 23, 27, 22, 28]
+
+
+class aosCamDistortion(object):
+    """
+    All camera distortion tables, stacked into one (nType, nRow, nCol)
+    array, so that every distortion, for any number of zenith angles, is
+    one expression. Rows of each table: 0 zenith, 1 and 2 horizon at camera
+    rotation 0 and 90 deg, 3-10 the temperatures in column 2; tables with
+    fewer columns are padded with zeros, up to self.nCol[distType].
+    """
+
+    def __init__(self):
+        aosSrcDir = os.path.split(os.path.abspath(__file__))[0]
+        tables = []
+        self.nCol = {}
+        for distType in distTypes:
+            data = loadData('%s/../data/camera/%s.txt' % (
+                aosSrcDir, distType), skiprows=1)
+            self.nCol[distType] = data.shape[1] - 3
+            tables.append(data)
+        self.temp = tables[0][3:, 2]
+        for data in tables:
+            assert np.array_equal(data[3:, 2], self.temp)
+
+        self.table = np.zeros((len(tables), tables[0].shape[0],
+                               max(self.nCol.values())))
+        for i, (distType, data) in enumerate(zip(distTypes, tables)):
+            if distType[-3:] == 'zer':
+                self.table[i, :, :len(zidx)] = data[:, 3:][
+                    :, [x - 1 for x in zidx]]
+            else:
+                self.table[i, :, :self.nCol[distType]] = data[:, 3:]
+
+    def tempWeights(self, camTB):
+        """
+        weights of rows 3-10 for camera body temperature camTB, linear
+        interpolation, held at the end values outside of the table
+        """
+        t = np.clip(camTB, self.temp[0], self.temp[-1])
+        p2 = np.clip(np.searchsorted(self.temp, t, side='right'),
+                     1, self.temp.shape[0] - 1)
+        p1 = p2 - 1
+        w1 = (self.temp[p2] - t) / (self.temp[p2] - self.temp[p1])
+        w2 = (t - self.temp[p1]) / (self.temp[p2] - self.temp[p1])
+        w = np.zeros(self.temp.shape)
+        w[p1] += w1
+        w[p2] += w2
+        return w
+
+    def evaluate(self, zAngle, camRot, camTB, pre_elev=0, pre_camR=0,
+                 pre_temp_cam=0):
+        """
+        Distortions at zenith angle(s) zAngle (radian), minus those at the
+        pre-compensation state; (nType, nCol), or (nAngle, nType, nCol)
+        for an array of zAngle.
+        """
+        z = np.asarray(zAngle, dtype=np.float64)[..., None, None]
+        t = self.table
+        distortion = t[:, 0] * np.cos(z) + (
+            t[:, 1] * np.cos(camRot) + t[:, 2] * np.sin(camRot)) * np.sin(z)
+        # pre-compensation
+        distortion = distortion - (t[:, 0] * np.cos(pre_elev) + (
+            t[:, 1] * np.cos(pre_camR) + t[:, 2] * np.sin(pre_camR)) *
+            np.sin(pre_elev))
+        # temperature
+        w = self.tempWeights(camTB) - self.tempWeights(pre_temp_cam)
+        return distortion + np.einsum('j,ijk->ik', w, t[:, 3:])
@@ -8,6 +8,8 @@ import glob
 import numpy as np
 import matplotlib.pyplot as plt
 
+from aosDataBundle import loadData
+
 
 class aosController(object):
 
@@ -50,7 +52,7 @@ class aosController(object):
             print('control strategy: %s' % self.strategy)
             print('Using y2 file: %s' % self.y2File)
         self.gain = gain
-        self.y2 = np.loadtxt(self.y2File)
+        self.y2 = loadData(self.y2File)
 
         # establish control authority of the DOFs
         aa = M1M3.force[:, :esti.nB13Max]
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+import glob
+import json
+import hashlib
+import warnings
+
+import numpy as np
+
+from aosCache import loadtxtCached
+
+# What goes into the bundle: (pattern in data/, np.loadtxt kwargs).
+# .npy files are copied as they are.
+bundleContents = [
+    ('M1M3/*.npy', {}),
+    ('M1M3/M1M3_LUT.txt', {}),
+    ('M2/*.DAT', {}),
+    ('M2/M2_GT_FEA.txt', {'skiprows': 1}),
+    ('camera/*.txt', {'skiprows': 1}),
+    ('*/senM*.txt', {}),
+    ('*/y2*.txt', {}),
+    ('*/intrinsic_zn*.txt', {}),
+    ('covM86.txt', {}),
+    ('pssn_alpha.txt', {}),
+    ('fwhmModel/*.txt', {}),
+    ('zAngleHistory*.txt', {}),
+]
+
+magic = b'AOSBNDL1'
+align = 64
+
+# the bundle of this process, see getBundle()
+_bundle = {}
+
+
+def getDataDir():
+    aosSrcDir = os.path.split(os.path.abspath(__file__))[0]
+    return os.path.realpath('%s/../data' % aosSrcDir)
+
+
+def getBundleFile():
+    """AOS_DATA_BUNDLE, or data/aos.bundle"""
+    return os.environ.get('AOS_DATA_BUNDLE', '%s/aos.bundle' % getDataDir())
+
+
+def listContents(dataDir=None):
+    """sorted [(name, kwargs)] of the files in dataDir that bundleContents
+    asks for; name is the path relative to dataDir"""
+    if dataDir is None:
+        dataDir = getDataDir()
+    contents = {}
+    for pattern, kwargs in bundleContents:
+        for filename in glob.glob('%s/%s' % (dataDir, pattern)):
+            contents[os.path.relpath(filename, dataDir)] = kwargs
+    return sorted(contents.items())
+
+
+def dataVersion(dataDir=None):
+    """sha1 of everything that goes into the bundle"""
+    if dataDir is None:
+        dataDir = getDataDir()
+    h = hashlib.sha1()
+    for name, kwargs in listContents(dataDir):
+        h.update(name.encode())
+        h.update(repr(sorted(kwargs.items())).encode())
+        with open('%s/%s' % (dataDir, name), 'rb') as fid:
+            h.update(fid.read())
+    return h.hexdigest()
+
+
+def buildBundle(bundleFile=None, dataDir=None):
+    """
+    Pack the bundleContents of dataDir into one file:
+    magic, header length, a json header with the version and an index of
+    {name: offset, dtype, shape, kwargs, size, mtime}, then the arrays, each
+    aligned to 64 bytes; size and mtime (ns) are those of data/name, for
+    aosDataBundle.get() to tell when it changed. Returns the version.
+    """
+    if dataDir is None:
+        dataDir = getDataDir()
+    if bundleFile is None:
+        bundleFile = getBundleFile()
+
+    arrays = []
+    index = {}
+    offset = 0
+    for name, kwargs in listContents(dataDir):
+        filename = '%s/%s' % (dataDir, name)
+        if name.endswith('.npy'):
+            a = np.load(filename)
+        else:
+            a = loadtxtCached(filename, **kwargs)
+        a = np.ascontiguousarray(a)
+        offset = -(-offset // align) * align
+        st = os.stat(filename)
+        index[name] = {'offset': offset, 'dtype': a.dtype.str,
+                       'shape': a.shape, 'kwargs': kwargs,
+                       'size': st.st_size, 'mtime': st.st_mtime_ns}
+        arrays.append((offset, a))
+        offset += a.nbytes
+
+    header = json.dumps({'version': dataVersion(dataDir),
+                         'index': index}).encode()
+    dataStart = -(-(len(magic) + 8 + len(header)) // align) * align
+    tmpFile = '%s.%d.tmp' % (bundleFile, os.getpid())
+    with open(tmpFile, 'wb') as fid:
+        fid.write(magic)
+        fid.write(np.uint64(len(header)).tobytes())
+        fid.write(header)
+        for offset, a in arrays:
+            fid.seek(dataStart + offset)
+            fid.write(a.tobytes())
+    os.replace(tmpFile, bundleFile)
+    return json.loads(header)['version']
+
+
+class aosDataBundle(object):
+    """
+    Read-only view of a bundle made by buildBundle(). The whole file is
+    memory-mapped once; get() hands out arrays on that map, as long as the
+    file in dataDir they came from has not changed since.
+    """
+
+    def __init__(self, bundleFile, dataDir=None):
+        if dataDir is None:
+            dataDir = getDataDir()
+        self.bundleFile = bundleFile
+        self.dataDir = dataDir
+        self.stale = set()
+        with open(bundleFile, 'rb') as fid:
+            if fid.read(len(magic)) != magic:
+                raise RuntimeError('%s is not a data bundle' % bundleFile)
+            n = int(np.frombuffer(fid.read(8), dtype=np.uint64)[0])
+            header = json.loads(fid.read(n).decode())
+        self.version = header['version']
+        self.index = header['index']
+        self.dataStart = -(-(len(magic) + 8 + n) // align) * align
+        self.buffer = np.memmap(bundleFile, dtype=np.uint8, mode='r')
+
+    def get(self, name, **kwargs):
+        """
+        The array of data/name, read with kwargs; None if it isn't in the
+        bundle, was read with other kwargs, or data/name has changed (size
+        or mtime) since the bundle was built.
+        """
+        entry = self.index.get(name)
+        if entry is None or entry['kwargs'] != kwargs:
+            return None
+        try:
+            st = os.stat('%s/%s' % (self.dataDir, name))
+            changed = (st.st_size != entry.get('size') or
+                       st.st_mtime_ns != entry.get('mtime'))
+        except OSError:
+            changed = True
+        if changed:
+            if name not in self.stale:
+                self.stale.add(name)
+                warnings.warn('%s: %s has changed, reading it from %s; '
+                              'rebuild the bundle with buildDataBundle.py' %
+                              (self.bundleFile, name, self.dataDir))
+            return None
+        a = np.ndarray(tuple(entry['shape']), dtype=entry['dtype'],
+                       buffer=self.buffer,
+                       offset=self.dataStart + entry['offset'])
+        a.setflags(write=False)
+        return a
+
+
+def getBundle():
+    """
+    The aosDataBundle at getBundleFile(), opened once per process;
+    None if there isn't one (or AOS_DATA_BUNDLE is empty).
+    """
+    bundleFile = getBundleFile()
+    if bundleFile not in _bundle:
+        if bundleFile and os.path.isfile(bundleFile):
+            _bundle[bundleFile] = aosDataBundle(bundleFile)
+        else:
+            _bundle[bundleFile] = None
+    return _bundle[bundleFile]
+
+
+def loadData(filename, **kwargs):
+    """
+    A model data file in data/: from the bundle when there is one with it
+    in, otherwise np.load(mmap_mode='r') for .npy and loadtxtCached() for
+    text files. Either way the array can be read-only.
+    """
+    bundle = getBundle()
+    if bundle is not None:
+        name = os.path.relpath(os.path.realpath(filename), getDataDir())
+        a = bundle.get(name, **kwargs)
+        if a is not None:
+            return a
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    return loadtxtCached(filename, **kwargs)
@@ -8,6 +8,7 @@ import glob
 
 import numpy as np
 from aosTeleState import aosTeleState
+from aosDataBundle import loadData
 
 class aosEstimator(object):
 
@@ -81,7 +82,7 @@ class aosEstimator(object):
 
         if debugLevel >= 1:
             print('Using senM file: %s' % self.senMFile)
-        self.senM = np.loadtxt(self.senMFile)
+        self.senM = loadData(self.senMFile)
         self.senM = self.senM.reshape((-1, self.zn3Max, self.senM.shape[1]))
         self.senM = self.senM[:, :, np.concatenate(
             (range(self.nB13Start + self.nB13Max),
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import sys
+
+import numpy as np
+import scipy.fft as fft
+
+# Stacked versions of opd2psf() and of otf2psf(psf2otf() * mtf) in aosMetric.
+# Everything works on the last two axes, so one call does all fields (and
+# wavelengths, when there is no padding) at once, with multi-threaded FFTs.
+axes = (-2, -1)
+
+
+def nextFastLen(n):
+    """
+    Smallest 2**a * 3**b * 5**c * 7**d that is >= n and has the parity of
+    n. Keeping the parity keeps the PSF window symmetric about its center
+    the same way as size n does (odd) or doesn't (even).
+    """
+    N = n
+    while True:
+        p = N
+        for f in (2, 3, 5, 7):
+            while p % f == 0:
+                p //= f
+        if p == 1:
+            return N
+        N += 2
+
+
+def padSize(m, padding, fast=False):
+    """
+    Size opd2psf() and createMTFatm() pad m pixels to, for a padding
+    factor; fast=True rounds it up to nextFastLen().
+    """
+    N = int(m + np.rint(((padding - 1) * m + 1e-5) / 2) * 2)  # add even
+    if fast:
+        N = nextFastLen(N)
+    return N
+
+
+def padStack(array, N):
+    """
+    padArray() on the last two axes. The center pixel (m//2) goes to N//2,
+    where fftshift() expects it, so N - m can also be odd.
+    """
+    m = array.shape[-1]
+    if m == N:
+        return array
+    out = np.zeros(array.shape[:-2] + (N, N), dtype=array.dtype)
+    i0 = N // 2 - m // 2
+    out[..., i0:i0 + m, i0:i0 + m] = array
+    return out
+
+
+def opd2psfStack(opd, wavelength, pupil=None, imagedelta=0, sensorFactor=1,
+                 fno=1.2335, fast=False, workers=-1):
+    """
+    opd2psf() on a (..., m, m) stack of wavefront OPDs in micron.
+    wavelength in micron, a number, or an array over the leading axes
+    when imagedelta=0.
+    pupil=None gets the pupil geometry from opd.
+    imagedelta in micron, use 0 if pixel size is not specified;
+    otherwise all OPDs get padded the same way, so wavelength has to be a
+    number.
+    fast=True pads to the next fast FFT size (see padSize()), so the PSF
+    pixels get smaller by the ratio of the two sizes; it has no effect
+    when imagedelta=0.
+    """
+    opd = np.where(np.isnan(opd), 0, opd)
+    if pupil is None:
+        pupil = (opd != 0)
+
+    if imagedelta != 0:
+        if opd.shape[-1] != opd.shape[-2]:
+            print('Error (opd2psfStack): Only square images are accepted.')
+            print('image size = (%d, %d)' % (opd.shape[-2], opd.shape[-1]))
+            sys.exit()
+
+        k = fno * wavelength / imagedelta
+        padding = k / sensorFactor
+        if padding < 1:
+            print('opd2psfStack: sampling too low, data inaccurate')
+            print('imagedelta needs to be smaller than fno*wlum=%4.2f um' % (
+                fno * wavelength))
+            print('         so that the padding factor > 1')
+            print('         otherwise we have to cut pupil to be < D')
+            sys.exit()
+
+        N = padSize(opd.shape[-1], padding, fast)
+        pupil = padStack(pupil, N)
+        opd = padStack(opd, N)
+
+    wavelength = np.asarray(wavelength, dtype=np.float64)[..., None, None]
+    z = pupil * np.exp(-2j * np.pi * opd / wavelength)
+    # |fftshift(fft2(fftshift(z)))|**2 == fftshift(|fft2(fftshift(z))|**2)
+    z = fft.fft2(fft.fftshift(z, axes=axes), axes=axes, workers=workers,
+                 overwrite_x=True)
+    z = fft.fftshift(z.real**2 + z.imag**2, axes=axes)
+    z /= np.sum(z, axis=axes, keepdims=True)
+    return z
+
+
+def psfConvolveMTF(psf, mtf, workers=-1):
+    """
+    otf2psf(psf2otf(psf) * mtf) for a (..., N, N) stack of psf and one
+    centered (N, N) mtf, e.g. from createMTFatm().
+
+    fftshift(fftshift(a)) is a at most a one pixel roll, which is a phase
+    in the other domain and drops out of the absolute value, so the two
+    inner shifts are folded into the mtf. When that mtf is symmetric, the
+    product is Hermitian and real-to-complex transforms are used.
+    """
+    N = psf.shape[-1]
+    mtf = fft.ifftshift(mtf)
+    psf = fft.fftshift(psf, axes=axes)
+    # mtf(-k), with index 0 at k=0
+    mtfFlip = np.roll(mtf[::-1, ::-1], 1, axis=(0, 1))
+    if np.array_equal(mtf, mtfFlip):
+        otf = fft.rfft2(psf, axes=axes, workers=workers)
+        otf *= mtf[:, :N // 2 + 1]
+        psf = np.absolute(fft.irfft2(otf, s=(N, N), axes=axes,
+                                     workers=workers))
+    else:
+        otf = fft.fft2(psf, axes=axes, workers=workers)
+        otf *= mtf
+        psf = np.absolute(fft.ifft2(otf, axes=axes, workers=workers))
+    return fft.fftshift(psf, axes=axes)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+import gzip
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# threads writing files; AOS_IO_THREADS, or runAOS -iothreads
+_ioThreads = int(os.environ.get('AOS_IO_THREADS', 4))
+_ioPool = None
+
+
+def setIOThreads(n):
+    """
+    at most n files are written at once; takes effect for the next pool
+    """
+    global _ioThreads, _ioPool
+    _ioThreads = max(1, n)
+    if _ioPool is not None:
+        _ioPool.shutdown()
+        _ioPool = None
+
+
+def getIOPool():
+    global _ioPool
+    if _ioPool is None:
+        _ioPool = ThreadPoolExecutor(_ioThreads)
+    return _ioPool
+
+
+def submitIO(func, *args):
+    """
+    runs func(*args) in the I/O pool; returns its future
+    """
+    return getIOPool().submit(func, *args)
+
+
+def readFile(path):
+    """
+    contents of path, unzipped if it ends with .gz
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as fid:
+            return fid.read()
+    with open(path, 'rb') as fid:
+        return fid.read()
+
+
+def writeFile(path, data, replaces=None):
+    """
+    writes data to path through a temporary file, so path is either
+    complete or not there; then removes replaces, e.g. the .gz it came from
+    """
+    tmpFile = '%s.%d.tmp' % (path, threading.get_ident())
+    try:
+        with open(tmpFile, 'wb') as fid:
+            fid.write(data)
+        os.replace(tmpFile, path)
+    except BaseException:
+        if os.path.isfile(tmpFile):
+            os.remove(tmpFile)
+        raise
+    if replaces is not None:
+        os.remove(replaces)
+
+
+def moveFile(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def collectFile(src, dstDir):
+    """
+    moves src into dstDir, unzipping it if it ends with .gz;
+    returns the new path
+    """
+    name = os.path.basename(src)
+    if name.endswith('.gz'):
+        dst = os.path.join(dstDir, name[:-3])
+        writeFile(dst, readFile(src), replaces=src)
+    else:
+        dst = os.path.join(dstDir, name)
+        moveFile(src, dst)
+    return dst
@@ -9,8 +9,46 @@ import numpy as np
 import aosCoTransform as ct
 from scipy.interpolate import Rbf
 
-from lsst.cwfs.tools import ZernikeAnnularFit
-from lsst.cwfs.tools import ZernikeAnnularEval
+from aosZernike import ZernikeProjector
+from aosDataBundle import loadData
+
+# M1M3 model data, attribute: (file in data/M1M3, column(s) or None).
+# Nothing is read in __init__; the first time an attribute is used its
+# file gets memory-mapped (or looked up in the data bundle), so a run only
+# reads what it needs, and worker processes share the pages.
+M1M3data = {
+    # bending modes, the grid is in M1 CRS, the attributes in Zemax CRS
+    'nodeID': ('M1M3_1um_156_grid.npy', 0),
+    'bx': ('M1M3_1um_156_grid.npy', 1),
+    'by': ('M1M3_1um_156_grid.npy', 2),
+    'bz': ('M1M3_1um_156_grid.npy', slice(3, None)),
+    'actID': ('M1M3_1um_156_force.npy', 0),
+    'actx': ('M1M3_1um_156_force.npy', 1),
+    'acty': ('M1M3_1um_156_force.npy', 2),
+    'force': ('M1M3_1um_156_force.npy', slice(3, None)),
+    # gravitational print through, in meter
+    'zdx': ('M1M3_dxdydz_zenith.npy', 0),
+    'zdy': ('M1M3_dxdydz_zenith.npy', 1),
+    'zdz': ('M1M3_dxdydz_zenith.npy', 2),
+    'hdx': ('M1M3_dxdydz_horizon.npy', 0),
+    'hdy': ('M1M3_dxdydz_horizon.npy', 1),
+    'hdz': ('M1M3_dxdydz_horizon.npy', 2),
+    'zf': ('M1M3_force_zenith.npy', None),
+    'hf': ('M1M3_force_horizon.npy', None),
+    'G': ('M1M3_influence_256.npy', None),
+    # first row is zenith angle in degree, then one row per actuator
+    'LUT': ('M1M3_LUT.txt', None),
+    # thermal deformation, in micron
+    'tbdz': ('tbdz.npy', None),
+    'txdz': ('txdz.npy', None),
+    'tydz': ('tydz.npy', None),
+    'tzdz': ('tzdz.npy', None),
+    'trdz': ('trdz.npy', None),
+    # how the force balance system responds to a single broken actuator,
+    # in meter (you see a lot of 1e-6)
+    'ULshape': ('M1M3_1000N_UL_shape_156.npy', None),
+}
+
 
 class aosM1M3(object):
 
@@ -30,76 +68,39 @@ class aosM1M3(object):
         self.alpha3[2] = -4.5e-22
         self.alpha3[3] = -8.15e-30
 
-        # bending modes
         aosSrcDir = os.path.split(os.path.abspath(__file__))[0]
-        aa = np.load('{}/../data/M1M3/M1M3_1um_156_grid.npy'.format(aosSrcDir))
-
-        self.nodeID = aa[:, 0]
-        self.bx = aa[:, 1]
-        self.by = aa[:, 2]
-        self.bz = aa[:, 3:]
-        aa = np.load('{}/../data/M1M3/M1M3_1um_156_force.npy'.format(aosSrcDir))
-
-        self.actID = aa[:, 0]
-        self.actx = aa[:, 1]
-        self.acty = aa[:, 2]
-        self.force = aa[:, 3:]
+        self.dataDir = '%s/../data/M1M3' % aosSrcDir
+        self.LUTfile = '%s/M1M3_LUT.txt' % self.dataDir
+        self.nzActuator = 156
+        self.nActuator = 256
 
         if debugLevel >= 3:
-            print('-b13--  %f' % self.bx[33])
-            print('-b13--  %f' % self.by[193])
+            # bending mode grid as in the file, in M1 CRS
+            x, y, z = ct.ZCRS2M1CRS(self.bx, self.by, self.bz)
+            print('-b13--  %f' % x[33])
+            print('-b13--  %f' % y[193])
             print('-b13--  %d' % np.sum(self.nodeID == 1))
-            print('-b13--  %e' % self.bz[332, 15])
-            print('-b13--  %e' % self.bz[4332, 15])
-
-        self.bx, self.by, self.bz = ct.M1CRS2ZCRS(self.bx, self.by, self.bz)
-
-        # data needed to determine gravitational print through
-        aa = np.load('{}/../data/M1M3/M1M3_dxdydz_zenith.npy'.format(aosSrcDir))
-        self.zdx = aa[:, 0]
-        self.zdy = aa[:, 1]
-        self.zdz = aa[:, 2]
-        aa = np.load('{}/../data/M1M3/M1M3_dxdydz_horizon.npy'.format(aosSrcDir))
-        self.hdx = aa[:, 0]
-        self.hdy = aa[:, 1]
-        self.hdz = aa[:, 2]
-        self.zf = np.load('{}/../data/M1M3/M1M3_force_zenith.npy'.format(aosSrcDir))
-        self.hf = np.load('{}/../data/M1M3/M1M3_force_horizon.npy'.format(aosSrcDir))
-        self.G = np.load('{}/../data/M1M3/M1M3_influence_256.npy'.format(aosSrcDir))
-
-        self.LUTfile = '{}/../data/M1M3/M1M3_LUT.txt'.format(aosSrcDir)
-        self.nzActuator = 156
-        self.nActuator = 256
+            print('-b13--  %e' % z[332, 15])
+            print('-b13--  %e' % z[4332, 15])
 
         # data needed to determine thermal deformation
-        aa = np.load('{}/../data/M1M3/M1M3_thermal_FEA.npy'.format(aosSrcDir))
-        x, y, _ = ct.ZCRS2M1CRS(self.bx, self.by, self.bz)
+        # tbdz, txdz, tydz, tzdz and trdz were interpolated from
+        # M1M3_thermal_FEA.npy onto the bending mode grid, in M1M3 coordinate
+        # system, and in micron:
+        # aa = np.load('%s/M1M3_thermal_FEA.npy' % self.dataDir)
+        # x, y, _ = ct.ZCRS2M1CRS(self.bx, self.by, self.bz)
         # these are normalized coordinates
         # n.b. these may not have been normalized correctly, b/c max(tx)=1.0
         # I tried to go back to the xls data, max(x)=164.6060 in,
         # while 4.18m=164.5669 in.
-        tx = aa[:, 0]
-        ty = aa[:, 1]
-        # below are in M1M3 coordinate system, and in micron
+        # tx = aa[:, 0]
+        # ty = aa[:, 1]
         # ip = Rbf(tx, ty, aa[:, 2])
         # self.tbdz = ip(x / self.R, y / self.R)
-        self.tbdz = np.load('{}/../data/M1M3/tbdz.npy'.format(aosSrcDir))
-        # ip = Rbf(tx, ty, aa[:, 3])
-        # self.txdz = ip(x / self.R, y / self.R)
-        self.txdz = np.load('{}/../data/M1M3/txdz.npy'.format(aosSrcDir))
-        # ip = Rbf(tx, ty, aa[:, 4])
-        # self.tydz = ip(x / self.R, y / self.R)
-        self.tydz = np.load('{}/../data/M1M3/tydz.npy'.format(aosSrcDir))
-        # ip = Rbf(tx, ty, aa[:, 5])
-        # self.tzdz = ip(x / self.R, y / self.R)
-        self.tzdz = np.load('{}/../data/M1M3/tzdz.npy'.format(aosSrcDir))
-        # ip = Rbf(tx, ty, aa[:, 6])
-        # self.trdz = ip(x / self.R, y / self.R)
-        self.trdz = np.load('{}/../data/M1M3/trdz.npy'.format(aosSrcDir))
-
-        # data needed to determine how force balance system will respond to a single broken actuator
-        # units are meter (you see a lot of 1e-6)
-        self.ULshape = np.load('{}/../data/M1M3/M1M3_1000N_UL_shape_156.npy'.format(aosSrcDir))
+        # and so on with columns 3-6 for txdz, tydz, tzdz and trdz
+
+        # Zernike fitting on the FEA nodes, see getZernikeProjector()
+        self.projectors = {}
 
 
     def idealShape(self, x, y, annulus, dr1=0, dr3=0, dk1=0, dk3=0):
@@ -107,6 +108,7 @@ class aosM1M3(object):
         x,y,and z0 are all in millimeter.
         annulus=1. these (x,y) are on M1 surface
         annulus=3. these (x,y) are on M3 surface
+        x and y can also be (nSurf, nNode) stacks over the nodes in annulus.
         """
         nr = x.shape
         mr = y.shape
@@ -125,9 +127,9 @@ class aosM1M3(object):
         idxM1 = annulus == 1
         idxM3 = annulus == 3
 
-        cMat = np.zeros(nr)
-        kMat = np.zeros(nr)
-        alphaMat = np.tile(np.zeros(nr), (8, 1))
+        cMat = np.zeros(annulus.shape)
+        kMat = np.zeros(annulus.shape)
+        alphaMat = np.tile(np.zeros(annulus.shape), (8, 1))
         cMat[idxM1] = c1
         cMat[idxM3] = c3
         kMat[idxM1] = k1
@@ -145,35 +147,96 @@ class aosM1M3(object):
         for i in range(8):
             z0 = z0 + alphaMat[i, :] * r2**(i + 1)
 
-        z0[idxM3] = z0[idxM3] + M3voffset
+        z0 = z0 + M3voffset * idxM3
         # in Zemax, z axis points from M1M3 to M2. We want z0>0
         return -z0
 
     def getPrintthz(self, zAngle):
         # M1M3 gravitational and thermal. Output is in meter
-        printthx = self.zdx * \
-            np.cos(zAngle) + self.hdx * np.sin(zAngle) # in meter
-        printthy = self.zdy * \
-            np.cos(zAngle) + self.hdy * np.sin(zAngle) # in meter
-        printthz = self.zdz * \
-            np.cos(zAngle) + self.hdz * np.sin(zAngle) # in meter
+        return self.getPrintthzStack(zAngle)[0]
+
+    def getPrintthzStack(self, zAngle):
+        """
+        getPrintthz() for an array of zenith angles at once;
+        returns (nAngle, nNode), in meter.
+        """
+        c = np.cos(zAngle).reshape((-1, 1))
+        s = np.sin(zAngle).reshape((-1, 1))
+        printthx = self.zdx * c + self.hdx * s # in meter
+        printthy = self.zdy * c + self.hdy * s # in meter
+        printthz = self.zdz * c + self.hdz * s # in meter
 
         # convert dz to grid sag
         # bx, by, bz, written out by senM35pointZMX.m, has been converted
         # to ZCRS, b/c we needed to import those directly into Zemax
-        x, y, _ = ct.ZCRS2M1CRS(self.bx, self.by, self.bz)
+        x, y, _ = ct.ZCRS2M1CRS(self.bx, self.by, 0)
         # self.idealShape() uses mm everywhere
         zpRef = self.idealShape((x + printthx) * 1000,
                                 (y + printthy) * 1000, self.nodeID) / 1000
         zRef = self.idealShape(x * 1000, y * 1000, self.nodeID) / 1000
-        # convert printthz into surface sag
+        # convert printthz into surface sag, then remove PTT
         printthz = printthz - (zpRef - zRef)
-        zc = ZernikeAnnularFit(printthz, x / self.R,
-                               y / self.R, 3, self.Ri / self.R)
-        printthz = printthz - ZernikeAnnularEval(
-            zc, x / self.R, y / self.R, self.Ri / self.R)
-        return printthz
-    
+        proj = self.getZernikeProjector(3, self.Ri / self.R, crs='M1CRS')
+        return proj.residual(printthz.T).T
+
+    def getZernikeProjector(self, numTerms, e=None, crs='ZCRS'):
+        """
+        ZernikeProjector on the FEA nodes (x/R, y/R), with x and y in the
+        Zemax CRS, or in the M1 CRS for crs='M1CRS'. Each one is made once
+        and kept with the mirror data in self.projectors.
+        """
+        key = (numTerms, e, crs)
+        if key not in self.projectors:
+            x, y = self.bx, self.by
+            if crs == 'M1CRS':
+                x, y, _ = ct.ZCRS2M1CRS(self.bx, self.by, 0)
+            self.projectors[key] = ZernikeProjector(
+                x / self.R, y / self.R, numTerms, e)
+        return self.projectors[key]
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set yet
+        if name not in M1M3data:
+            raise AttributeError(
+                "'aosM1M3' object has no attribute '%s'" % name)
+        fileName, col = M1M3data[name]
+        a = loadData('%s/%s' % (self.dataDir, fileName))
+        if col is not None:
+            a = a[:, col]
+        # bx, by, bz, written out by senM35pointZMX.m, need to be in ZCRS,
+        # b/c we need to import those directly into Zemax
+        if name == 'bx':
+            a, _, _ = ct.M1CRS2ZCRS(a, 0, 0)
+        elif name == 'bz':
+            _, _, a = ct.M1CRS2ZCRS(0, 0, a)
+        setattr(self, name, a)
+        return a
+
+    def getLUTforce(self, zAngle):
+        """
+        Actuator forces from the LUT, interpolated linearly in zenith angle
+        (in degree), and held at the end values outside of the table.
+        Returns (nActuator,) for one angle, (nAngle, nActuator) for an
+        array of them.
+        """
+        ruler = self.LUT[0, :]
+        step = ruler[1] - ruler[0]
+        z = np.asarray(zAngle, dtype=np.float64)
+        # p2 is the first column with ruler >= z
+        p2 = np.searchsorted(ruler, z)
+        p1 = p2 - 1
+        w2 = (z - ruler[np.maximum(p1, 0)]) / step
+        w1 = (ruler[np.minimum(p2, ruler.shape[0] - 1)] - z) / step
+        # too small or too large to be in range
+        low = (p2 == 0)
+        high = (p2 == ruler.shape[0])
+        p1 = np.where(low, 0, np.where(high, ruler.shape[0] - 1, p1))
+        p2 = np.where(high, ruler.shape[0] - 1, p2)
+        w1 = np.where(low | high, 1, w1)
+        w2 = np.where(low | high, 0, w2)
+        lut = self.LUT[1:, :]
+        return (w1[..., None] * lut[:, p1].T + w2[..., None] * lut[:, p2].T)
+
     def getFBshape(self, actID, f):
         #force balance system will add this addtional shape to M1M3
         idx = self.actID == actID
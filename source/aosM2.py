@@ -6,6 +6,8 @@
 import os
 import numpy as np
 import aosCoTransform as ct
+from aosZernike import ZernikeProjector
+from aosDataBundle import loadData
 
 
 class aosM2(object):
@@ -15,12 +17,12 @@ class aosM2(object):
         self.Ri = 0.9
         # bending modes
         aosSrcDir = os.path.split(os.path.abspath(__file__))[0]
-        aa = np.loadtxt('%s/../data/M2/M2_1um_grid.DAT'%aosSrcDir)
+        aa = loadData('%s/../data/M2/M2_1um_grid.DAT'%aosSrcDir)
         self.bx = aa[:, 0]
         self.by = aa[:, 1]
         self.bz = aa[:, 2:]
         # !!! we are using M1M3 forces in place of M2 forces
-        aa = np.loadtxt('%s/../data/M2/M2_1um_force.DAT'%aosSrcDir)
+        aa = loadData('%s/../data/M2/M2_1um_force.DAT'%aosSrcDir)
         self.force = aa[:, :]
 
         if debugLevel >= 3:
@@ -33,7 +35,7 @@ class aosM2(object):
         self.bx, self.by, self.bz = ct.M2CRS2ZCRS(self.bx, self.by, self.bz)
 
         # M2 gravitational and thermal deformations
-        aa = np.loadtxt('%s/../data/M2/M2_GT_FEA.txt'%aosSrcDir, skiprows=1)
+        aa = loadData('%s/../data/M2/M2_GT_FEA.txt'%aosSrcDir, skiprows=1)
         x, y, _ = ct.ZCRS2M2CRS(self.bx, self.by, self.bz)
         # first two columns are normalized x and y,
         # should be the same as the x,y converted from the bending modes x and
@@ -43,6 +45,9 @@ class aosM2(object):
         self.tzdz = aa[:, 4]  # in micron
         self.trdz = aa[:, 5]  # in micron
 
+        # Zernike fitting on the FEA nodes, see getZernikeProjector()
+        self.projectors = {}
+
     def getPrintthz(self, zAngle):
         printthz = self.zdz * np.cos(zAngle) \
           + self.hdz * np.sin(zAngle)
@@ -50,4 +55,23 @@ class aosM2(object):
         printthz -= self.zdz * np.cos(pre_comp_elev) \
           + self.hdz * np.sin(pre_comp_elev)
         return printthz
+
+    def getPrintthzStack(self, zAngle):
+        """
+        getPrintthz() for an array of zenith angles at once;
+        returns (nAngle, nNode), in micron.
+        """
+        return self.getPrintthz(np.reshape(zAngle, (-1, 1)))
+
+    def getZernikeProjector(self, numTerms, e=None):
+        """
+        ZernikeProjector on the FEA nodes (x/R, y/R), with x and y in the
+        Zemax CRS. Each one is made once and kept with the mirror data in
+        self.projectors.
+        """
+        key = (numTerms, e)
+        if key not in self.projectors:
+            self.projectors[key] = ZernikeProjector(
+                self.bx / self.R, self.by / self.R, numTerms, e)
+        return self.projectors[key]
     
@@ -5,7 +5,8 @@
 
 import os
 import sys
-import multiprocessing
+from collections import OrderedDict
+from functools import lru_cache
 
 import numpy as np
 import scipy.special as sp
@@ -13,19 +14,30 @@ from astropy.io import fits
 
 from lsst.cwfs.tools import padArray
 from lsst.cwfs.tools import extractArray
-from lsst.cwfs.tools import ZernikeAnnularFit
-from lsst.cwfs.tools import ZernikeAnnularEval
 
 from lsst.cwfs.errors import nonSquareImageError
 from aosErrors import psfSamplingTooLowError
+from aosZernike import removePTT
+from aosFFT import padSize, padStack, opd2psfStack, psfConvolveMTF
+from aosCache import arrayKey, ArtifactCache
+from aosDataBundle import loadData
+from aosPool import aosPool, getShared
 from aosTeleState import aosTeleState
 
 import matplotlib.pyplot as plt
 
+# reference terms of calc_pssn(), least recently used first: the
+# atmosphere MTFs, (m*k)^2 floats each, and (pssa, psftSum) of each pupil
+_atmosphereMTF = OrderedDict()
+maxAtmosphereMTF = 8
+_referencePSS = OrderedDict()
+maxReferencePSS = 256
+
 
 class aosMetric(object):
 
-    def __init__(self, instName, opdSize, znwcs3, debugLevel, pixelum=10):
+    def __init__(self, instName, opdSize, znwcs3, debugLevel, pixelum=10,
+                 fastFFT=False):
         aosSrcDir = os.path.split(os.path.abspath(__file__))[0]            
         if instName[:4] == 'lsst':
             self.nArm = 6
@@ -85,41 +97,124 @@ class aosMetric(object):
             print(self.w.shape)
             print(self.w)
 
-        aa = np.loadtxt('%s/../data/pssn_alpha.txt'%aosSrcDir)
+        aa = loadData('%s/../data/pssn_alpha.txt'%aosSrcDir)
         self.pssnAlpha = aa[:, 0]
         # self.pssnRange = aa[: 1]
 
         self.znx2 = np.zeros((self.nFieldp4, znwcs3))
         self.stampD = 2**np.ceil(np.log2(opdSize))
+        # pad the OPD-based ellipticity FFTs to fast sizes
+        self.fastFFT = fastFFT
 
-    def getFWHMfromZ(self):
-        self.fwhm = np.zeros(self.nField)
+    def getZTrue(self, state):
+        """
+        Zernikes (in um) of the OPD maps in zTrueFile, as
+        (nOPDw, nField, znwcs), and the wavelength of each run
+        """
+        aa = np.loadtxt(state.zTrueFile).reshape(state.nOPDw, self.nFieldp4,
+                                                 -1)
+        if state.nOPDw == 1:
+            wlum = [state.wavelength]
+        else:
+            wlum = aosTeleState.GQwave[state.band]
+        return aa[:, :self.nField, :], wlum
 
-    def getPSSNfromZ(self):
-        pass
+    def getFWHMfromZ(self, state, debugLevel, outFile=''):
+        """
+        FWHM (in mas) of each field from the Zernikes in zTrueFile, with
+        the quadratic model of data/fwhmModel (made at 500nm):
+        fwhm = cave + sum(bi * z) + sum(ai * z**2) + sum(cor * z_i * z_j).
+        Saved to outFile (default zFWHMFile). Only there for lsst.
+        """
+        self.fwhm = np.zeros(self.nField)
+        if not hasattr(self, 'fwhmModelFileBase'):
+            print('getFWHMfromZ: no FWHM model for this instrument')
+            return
+        if not outFile:
+            outFile = self.zFWHMFile
+        if not hasattr(self, 'fwhmModel'):
+            self.fwhmModel = [loadData('%s_%s.txt' % (
+                self.fwhmModelFileBase, name)) for name in (
+                    'ai', 'bi', 'cave', 'cor')]
+        ai, bi, cave, cor = self.fwhmModel
+        cor = cor.reshape(self.nField, ai.shape[1], ai.shape[1])
+
+        z, _ = self.getZTrue(state)
+        if state.nOPDw == 1:
+            wt = np.ones(1)
+        else:
+            wt = np.array(aosTeleState.GQwt[state.band])
+        for irun in range(state.nOPDw):
+            zi = z[irun, :, :ai.shape[1]]
+            fwhmw = (cave + np.sum(bi * zi, axis=1) +
+                     np.sum(ai * zi**2, axis=1) +
+                     np.einsum('fij,fi,fj->f', cor, zi, zi))
+            self.fwhm += wt[irun] * fwhmw
+
+        self.GQfwhm = np.sum(self.w * self.fwhm)
+        np.savetxt(outFile, np.concatenate((self.fwhm,
+                                            self.GQfwhm * np.ones(1))))
+        if debugLevel >= 2:
+            print(self.GQfwhm)
+
+    def getPSSNfromZ(self, state, debugLevel, outFile=''):
+        """
+        PSSN, FWHMeff and dm5 from the Zernikes in zTrueFile instead of
+        FFTs, with the quadratic model aosController uses for CCmat:
+        PSSN = 1 - sum(pssnAlpha * (2 pi z/wlum)**2) over z4 and up.
+        Only good for small aberrations. Saved to outFile like
+        getPSSNandMore() does (default PSSNFile).
+        """
+        if not outFile:
+            outFile = self.PSSNFile
+        z, wlum = self.getZTrue(state)
+        self.PSSNw = np.zeros((self.nField, state.nOPDw))
+        for irun in range(state.nOPDw):
+            self.PSSNw[:, irun] = pssnFromZ(z[irun, :, 3:], wlum[irun],
+                                            self.pssnAlpha)
+        self.writePSSN(state, outFile, debugLevel)
+
+    def comparePSSN(self, zFile, fftFile, zFWHMFile='', fftFWHMFile=''):
+        """
+        Print how far the PSSN, FWHMeff and dm5 in zFile (getPSSNfromZ())
+        are from those in fftFile (FFT based), and, when both files are
+        there, the FWHM in zFWHMFile (getFWHMfromZ()) from the one in
+        fftFWHMFile (getOPDMetrics(fwhm=True)).
+        """
+        aa = np.loadtxt(zFile)
+        bb = np.loadtxt(fftFile)
+        rows = [(name, aa[i, :] - bb[i, :])
+                for i, name in enumerate(('PSSN', 'FWHMeff', 'dm5'))]
+        if os.path.isfile(zFWHMFile) and os.path.isfile(fftFWHMFile):
+            rows.append(('FWHM', np.loadtxt(zFWHMFile) -
+                         np.loadtxt(fftFWHMFile)))
+        print('from Zernikes - from FFT, worst field and GQ:')
+        for name, d in rows:
+            print('%8s: %10.4e %10.4e' % (name, d[np.argmax(np.abs(d[:-1]))],
+                                          d[-1]))
 
     def getFFTPSF(self, fftpsfoff, state, imagedelta, numproc,
                   debugLevel, sensorfactor=1, fno=1.2335):
 
         if not fftpsfoff:
-            argList = []
+            opdFile = ['%s/iter%d/sim%d_iter%d_opd%d.fits' % (
+                state.imageDir, state.iIter, state.iSim, state.iIter, i)
+                for i in range(self.nField)]
+            # remove PTT, for consistence with calc_pssn,
+            # in principle doesn't matter, in practice, this affects
+            # centering, so it affects edge cutoff on psf
+            opd = readOPDStack(opdFile, state.opdx, state.opdy)
+            psf = opd2psfStack(opd, state.effwave, imagedelta=imagedelta,
+                               sensorFactor=sensorfactor, fno=fno,
+                               workers=numproc)
             for i in range(self.nField):
-                opdFile = '%s/iter%d/sim%d_iter%d_opd%d.fits' % (
-                    state.imageDir, state.iIter, state.iSim, state.iIter, i)
-                psfFile = opdFile.replace('opd', 'fftpsf')
-                argList.append((opdFile, state, imagedelta,
-                                sensorfactor, fno, psfFile,
-                                debugLevel))
-                if sys.platform == 'darwin':
-                    runFFTPSF(argList[i])
-
-            if sys.platform != 'darwin':
-                # test, pdb cannot go into the subprocess
-                # runFFTPSF(argList[0])
-                pool = multiprocessing.Pool(numproc)
-                pool.map(runFFTPSF, argList)
-                pool.close()
-                pool.join()
+                psfFile = opdFile[i].replace('opd', 'fftpsf')
+                if debugLevel >= 2:
+                    print('getFFTPSF: %s ' % psfFile)
+                if os.path.isfile(psfFile):
+                    os.remove(psfFile)
+                hdu = fits.PrimaryHDU(psf[i])
+                hdu.writeto(psfFile)
 
             plt.figure(figsize=(10, 10))
             for i in range(self.nField):
@@ -157,91 +252,56 @@ class aosMetric(object):
 
     def getPSSNandMore(self, pssnoff, state, numproc,
                        debugLevel,
-                       outFile='', pixelum=0):
+                       outFile='', pixelum=0, pool=None):
         """
         pixelum = 0: the input is opd map
         pixelum != 0: input is a fine-pixel PSF image stamp
+        pool: the aosPool of the run, for pixelum != 0
         """
         if not outFile:
             outFile = self.PSSNFile
 
         if not pssnoff:
-            # multithreading on MacOX doesn't work with pinv
-            # before we calc_pssn, we do ZernikeFit to remove PTT
-            # pinv appears in ZernikeFit()
-            if sys.platform == 'darwin':
+            if pixelum == 0:
+                # all fields of one wavelength go through FFTs together
                 self.PSSNw = np.zeros((self.nField, state.nOPDw))
-            argList = []
-            icount = 0
-            for i in range(self.nField):
                 for irun in range(state.nOPDw):
-                    inputFile = []
-                    if pixelum > 0:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_psf%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter,
-                            i))
-                    elif pixelum < 0:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_fftpsf%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter,
-                            i))
-                        
-                    if state.nOPDw == 1:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_opd%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter, i))
-                        wlum = state.wavelength
-                    else:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_opd%d_w%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter, i, irun))
-                        wlum = aosTeleState.GQwave[state.band][irun]
-                    argList.append((inputFile, state,
-                                        wlum, debugLevel, pixelum))
-
-                    if sys.platform == 'darwin':
-                        self.PSSNw[i, irun] = runPSSNandMore(argList[icount])
-                    icount += 1
-                    
-            if sys.platform != 'darwin':
-                # test, pdb cannot go into the subprocess
-                # aa = runPSSNandMore(argList[0])
-                pool = multiprocessing.Pool(numproc)
-                self.PSSNw = pool.map(runPSSNandMore, argList)
-                pool.close()
-                pool.join()
-                self.PSSNw = np.array(self.PSSNw).reshape(self.nField, -1)
-
-            wt = np.tile(np.array(aosTeleState.GQwt[state.band]),
-                             (self.nField,1))
-            self.PSSN = np.sum(wt * self.PSSNw, axis=1)
-            self.FWHMeff = 1.086 * 0.6 * np.sqrt(1 / self.PSSN - 1)
-            self.dm5 = -1.25 * np.log10(self.PSSN)
-
-            if debugLevel >= 2:
-                for i in range(self.nField):
-                    print('---field#%d, PSSN=%7.4f, FWHMeff = %5.0f mas' % (
-                        i, self.PSSN[i], self.FWHMeff[i] * 1e3))
-
-            self.GQPSSN = np.sum(self.w * self.PSSN)
-            self.GQFWHMeff = np.sum(self.w * self.FWHMeff)
-            self.GQdm5 = np.sum(self.w * self.dm5)
-            a1 = np.concatenate((self.PSSN, self.GQPSSN * np.ones(1)))
-            a2 = np.concatenate((self.FWHMeff, self.GQFWHMeff * np.ones(1)))
-            a3 = np.concatenate((self.dm5, self.GQdm5 * np.ones(1)))
-            np.savetxt(outFile, np.vstack((a1, a2, a3)))
-
-            if debugLevel >= 2:
-                print(self.GQPSSN)
+                    opdFile, wlum = self.getOPDFiles(state, irun)
+                    opd = readOPDStack(opdFile, state.opdx, state.opdy)
+                    self.PSSNw[:, irun], _ = calc_pssnStack(
+                        opd, wlum, workers=numproc, debugLevel=debugLevel)
+            else:
+                self.PSSNw = self.runPerField(runPSSNandMore, state, numproc,
+                                              debugLevel, pixelum, pool)
+            self.writePSSN(state, outFile, debugLevel)
         else:
             aa = np.loadtxt(outFile)
             self.GQFWHMeff = aa[1, -1]  # needed for shiftGear
 
+    def writePSSN(self, state, outFile, debugLevel):
+        """PSSN, FWHMeff and dm5 from self.PSSNw, saved to outFile"""
+        wt = np.tile(np.array(aosTeleState.GQwt[state.band]),
+                         (self.nField,1))
+        self.PSSN = np.sum(wt * self.PSSNw, axis=1)
+        self.FWHMeff = 1.086 * 0.6 * np.sqrt(1 / self.PSSN - 1)
+        self.dm5 = -1.25 * np.log10(self.PSSN)
+
+        if debugLevel >= 2:
+            for i in range(self.nField):
+                print('---field#%d, PSSN=%7.4f, FWHMeff = %5.0f mas' % (
+                    i, self.PSSN[i], self.FWHMeff[i] * 1e3))
+
+        self.GQPSSN = np.sum(self.w * self.PSSN)
+        self.GQFWHMeff = np.sum(self.w * self.FWHMeff)
+        self.GQdm5 = np.sum(self.w * self.dm5)
+        a1 = np.concatenate((self.PSSN, self.GQPSSN * np.ones(1)))
+        a2 = np.concatenate((self.FWHMeff, self.GQFWHMeff * np.ones(1)))
+        a3 = np.concatenate((self.dm5, self.GQdm5 * np.ones(1)))
+        np.savetxt(outFile, np.vstack((a1, a2, a3)))
+
+        if debugLevel >= 2:
+            print(self.GQPSSN)
+
     def getPSSNandMorefromBase(self, baserun, state):
         if not os.path.isfile(self.PSSNFile):
             baseFile = self.PSSNFile.replace(
@@ -250,78 +310,141 @@ class aosMetric(object):
         aa = np.loadtxt(self.PSSNFile)
         self.GQFWHMeff = aa[1, -1]  # needed for shiftGear
 
+    def getOPDFiles(self, state, irun):
+        """OPD files of all fields, and their wavelength, for run irun"""
+        if state.nOPDw == 1:
+            opdFile = ['%s/iter%d/sim%d_iter%d_opd%d.fits' % (
+                state.imageDir, state.iIter, state.iSim, state.iIter, i)
+                for i in range(self.nField)]
+            wlum = state.wavelength
+        else:
+            opdFile = ['%s/iter%d/sim%d_iter%d_opd%d_w%d.fits' % (
+                state.imageDir, state.iIter, state.iSim, state.iIter, i, irun)
+                for i in range(self.nField)]
+            wlum = aosTeleState.GQwave[state.band][irun]
+        return opdFile, wlum
+
+    def runPerField(self, func, state, numproc, debugLevel, pixelum,
+                    pool=None):
+        """
+        func (runPSSNandMore or runEllipticity) on the fine-pixel PSF stamp
+        of each field and wavelength, on pool, or on a pool of numproc
+        processes made for this call. Returns (nField, nOPDw).
+        """
+        argList = []
+        for i in range(self.nField):
+            for irun in range(state.nOPDw):
+                inputFile = []
+                if pixelum > 0:
+                    inputFile.append(
+                        '%s/iter%d/sim%d_iter%d_psf%d.fits' % (
+                        state.imageDir, state.iIter, state.iSim,
+                        state.iIter,
+                        i))
+                elif pixelum < 0:
+                    inputFile.append(
+                        '%s/iter%d/sim%d_iter%d_fftpsf%d.fits' % (
+                        state.imageDir, state.iIter, state.iSim,
+                        state.iIter,
+                        i))
+                opdFile, wlum = self.getOPDFiles(state, irun)
+                inputFile.append(opdFile[i])
+                argList.append((inputFile, wlum, debugLevel, pixelum))
+
+        if pool is None:
+            with aosPool(numproc, arrays={'opdx': state.opdx,
+                                          'opdy': state.opdy}) as pool:
+                out = pool.map(func, argList)
+        else:
+            out = pool.map(func, argList)
+        return np.array(out).reshape(self.nField, -1)
+
     def getEllipticity(self, ellioff, state, numproc,
                        debugLevel,
-                       outFile='', pixelum=0):
+                       outFile='', pixelum=0, pool=None):
         """
         pixelum = 0: the input is opd map
         pixelum != 0: input is a fine-pixel PSF image stamp
+        pool: the aosPool of the run, for pixelum != 0
         """
         if not outFile:
             outFile = self.elliFile
 
         if not ellioff:
-            # multithreading on MacOX doesn't work with pinv
-            # before we psf2eAtmW(), we do ZernikeFit to remove PTT
-            # pinv appears in ZernikeFit()
-            if sys.platform == 'darwin':
+            if pixelum == 0:
+                # all fields of one wavelength go through FFTs together
                 self.elliw = np.zeros((self.nField, state.nOPDw))
-            argList = []
-            icount = 0
-            for i in range(self.nField):
                 for irun in range(state.nOPDw):
-                    inputFile = []
-                    if pixelum > 0:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_psf%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter,
-                            i))
-                    elif pixelum < 0:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_fftpsf%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter,
-                            i))
-
-                    if state.nOPDw == 1:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_opd%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter, i))
-                        wlum = state.wavelength
-                    else:
-                        inputFile.append(
-                            '%s/iter%d/sim%d_iter%d_opd%d_w%d.fits' % (
-                            state.imageDir, state.iIter, state.iSim,
-                            state.iIter, i, irun))
-                        wlum = aosTeleState.GQwave[state.band][irun]
-                    argList.append((inputFile, state,
-                                    wlum, debugLevel, pixelum))
-
-                    if sys.platform == 'darwin':
-                        self.elliw[i, irun] = runEllipticity(argList[icount])
-                    icount += 1
-
-            if sys.platform != 'darwin':
-                pool = multiprocessing.Pool(numproc)
-                self.elliw = pool.map(runEllipticity, argList)
-                pool.close()
-                pool.join()
-                self.elliw = np.array(self.elliw).reshape(self.nField, -1)
-
-            wt = np.tile(np.array(aosTeleState.GQwt[state.band]),
-                             (self.nField,1))
-            self.elli = np.sum(wt * self.elliw, axis = 1)
-            for i in range(self.nField):
-                if debugLevel >= 2:
-                    print('---field#%d, elli=%7.4f' % (i, self.elli[i]))
-
-            self.GQelli = np.sum(self.w * self.elli)
-            a1 = np.concatenate((self.elli, self.GQelli * np.ones(1)))
-            np.savetxt(outFile, a1)
+                    opdFile, wlum = self.getOPDFiles(state, irun)
+                    opd = readOPDStack(opdFile, state.opdx, state.opdy)
+                    self.elliw[:, irun] = psf2eAtmWStack(
+                        opd, wlum, fast=self.fastFFT, workers=numproc,
+                        debugLevel=debugLevel)
+            else:
+                self.elliw = self.runPerField(runEllipticity, state, numproc,
+                                              debugLevel, pixelum, pool)
+            self.writeElli(state, outFile, debugLevel)
+
+    def writeElli(self, state, outFile, debugLevel):
+        """ellipticity from self.elliw, saved to outFile"""
+        wt = np.tile(np.array(aosTeleState.GQwt[state.band]),
+                         (self.nField,1))
+        self.elli = np.sum(wt * self.elliw, axis = 1)
+        for i in range(self.nField):
             if debugLevel >= 2:
-                print(self.GQelli)
+                print('---field#%d, elli=%7.4f' % (i, self.elli[i]))
+
+        self.GQelli = np.sum(self.w * self.elli)
+        a1 = np.concatenate((self.elli, self.GQelli * np.ones(1)))
+        np.savetxt(outFile, a1)
+        if debugLevel >= 2:
+            print(self.GQelli)
+
+    def getOPDMetrics(self, pssnoff, ellioff, state, numproc, debugLevel,
+                      fwhm=False):
+        """
+        getPSSNandMore() and getEllipticity() from the OPD maps in one pass:
+        each OPD is read and has its PTT removed once, for PSSN, FWHMeff,
+        dm5, and ellipticity. fwhm=True also gets the psf2FWHMring() FWHM
+        from the same PSSN PSFs, saved to FWHMFile.
+        """
+        if not pssnoff:
+            self.PSSNw = np.zeros((self.nField, state.nOPDw))
+            if fwhm:
+                self.FWHMw = np.zeros((self.nField, state.nOPDw))
+        if not ellioff:
+            self.elliw = np.zeros((self.nField, state.nOPDw))
+
+        if not (pssnoff and ellioff):
+            for irun in range(state.nOPDw):
+                opdFile, wlum = self.getOPDFiles(state, irun)
+                opd = readOPDStack(opdFile, state.opdx, state.opdy)
+                if not pssnoff:
+                    _, psftot, pss, pssa, mtfa = pssnStackTerms(
+                        opd, wlum, workers=numproc, debugLevel=debugLevel)
+                    self.PSSNw[:, irun] = pss / pssa
+                    if fwhm:
+                        self.FWHMw[:, irun] = fwhmStack(
+                            opd, psftot, mtfa, wlum, workers=numproc)
+                if not ellioff:
+                    self.elliw[:, irun] = psf2eAtmWStack(
+                        opd, wlum, fast=self.fastFFT, workers=numproc,
+                        debugLevel=debugLevel)
+
+        if not pssnoff:
+            self.writePSSN(state, self.PSSNFile, debugLevel)
+            if fwhm:
+                wt = np.tile(np.array(aosTeleState.GQwt[state.band]),
+                             (self.nField, 1))
+                self.FWHMring = np.sum(wt * self.FWHMw, axis=1)
+                self.GQFWHMring = np.sum(self.w * self.FWHMring)
+                np.savetxt(self.FWHMFile, np.concatenate(
+                    (self.FWHMring, self.GQFWHMring * np.ones(1))))
+        else:
+            aa = np.loadtxt(self.PSSNFile)
+            self.GQFWHMeff = aa[1, -1]  # needed for shiftGear
+        if not ellioff:
+            self.writeElli(state, self.elliFile, debugLevel)
 
     def getEllipticityfromBase(self, baserun, state):
         if not os.path.isfile(self.elliFile):
@@ -377,8 +500,6 @@ def calc_pssn(array, wlum, type='opd', D=8.36, r0inmRef=0.1382, zen=0,
         # pupil needs to be padded k times larger to get imagedelta
         k = fno * wlum / imagedelta
 
-    mtfa = createMTFatm(D, m, k, wlum, zen, r0inmRef)
-
     if type == 'opd':
         try:
             iad = (array2D != 0)
@@ -391,13 +512,9 @@ def calc_pssn(array, wlum, type='opd', D=8.36, r0inmRef=0.1382, zen=0,
     # number of non-zero elements, used for normalization later
     # miad2 = np.count_nonzero(iad)
 
-    # Perfect telescope
-    opdt = np.zeros((m, m))
-    psft = opd2psf(opdt, iad, wlum, imagedelta, 1, fno, debugLevel)
-    otft = psf2otf(psft)  # OTF of perfect telescope
-    otfa = otft * mtfa  # add atmosphere to perfect telescope
-    psfa = otf2psf(otfa)
-    pssa = np.sum(psfa**2)  # atmospheric PSS = 1/neff_atm
+    # Perfect telescope, and the atmosphere; these don't depend on array
+    mtfa, pssa, psftSum = getReferencePSS(iad, wlum, imagedelta, fno,
+                                          D, m, k, zen, r0inmRef, debugLevel)
 
     # Error;
     if type == 'opd':
@@ -427,7 +544,7 @@ def calc_pssn(array, wlum, type='opd', D=8.36, r0inmRef=0.1382, zen=0,
             print('IQ is over-estimated !!!')
             psfe = padArray(array, mk)
 
-        psfe = psfe / np.sum(psfe) * np.sum(psft)
+        psfe = psfe / np.sum(psfe) * psftSum
 
     pixmas = imagedelta * 20
     aa = psfe/np.sum(psfe)
@@ -446,36 +563,212 @@ def calc_pssn(array, wlum, type='opd', D=8.36, r0inmRef=0.1382, zen=0,
     return pssn, fwhmeff
 
 
-def createMTFatm(D, m, k, wlum, zen, r0inmRef):
+def pssnFromZ(z, wlum, alpha):
+    """
+    PSSN = 1 - sum(alpha * (2 pi z/wlum)**2) for Zernikes z (in um, z4 and
+    up) on the last axis; z can have more terms than alpha.
+    The quadratic goes to 0 and below for large aberrations (about 1 um of
+    z4 at 0.5 um), so it is clipped to [1e-6, 1] to keep FWHMeff and dm5
+    finite.
+    """
+    z = np.asarray(z)[..., :len(alpha)]
+    return np.clip(1 - np.sum(alpha * (2 * np.pi * z / wlum)**2, axis=-1),
+                   1e-6, 1)
+
+
+def calc_pssnStack(opd, wlum, D=8.36, r0inmRef=0.1382, zen=0, fno=1.2335,
+                   workers=-1, debugLevel=0):
+    """
+    calc_pssn() with type='opd' on a (nOPD, m, m) stack of single-OPD
+    fields at one wavelength. The error PSFs and their convolution with the
+    atmosphere are done as stacked FFTs on workers threads.
+    Returns pssn and fwhmeff, each (nOPD,).
+    """
+    psfe, _, pss, pssa, _ = pssnStackTerms(opd, wlum, D, r0inmRef, zen, fno,
+                                           workers, debugLevel)
+
+    pixmas = fno * wlum * 20
+    neff = 1 / np.sum(psfe**2, axis=(1, 2))  # psfe sums to 1
+    fwhmeff = 0.664 * pixmas * np.sqrt(neff)
+
+    return pss / pssa, fwhmeff
+
+
+def pssnStackTerms(opd, wlum, D=8.36, r0inmRef=0.1382, zen=0, fno=1.2335,
+                   workers=-1, debugLevel=0):
+    """
+    What calc_pssnStack() is built from: the error PSFs, the error +
+    atmosphere PSFs and their PSS, the PSS of a perfect telescope with the
+    same pupils, and the atmosphere MTF.
+    """
+    m = opd.shape[-1]
+    k = 1
+    imagedelta = fno * wlum
+
+    mtfa = None
+    pssa = np.zeros(opd.shape[0])
+    for i in range(opd.shape[0]):
+        # the pupil (and so pssa) can differ from field to field
+        mtfa, pssa[i], _ = getReferencePSS(opd[i] != 0, wlum, imagedelta,
+                                           fno, D, m, k, zen, r0inmRef,
+                                           debugLevel)
+
+    psfe = opd2psfStack(opd, wlum, workers=workers)
+    psftot = psfConvolveMTF(psfe, mtfa, workers=workers)
+    pss = np.sum(psftot**2, axis=(1, 2))  # atmospheric + error PSS
+
+    if debugLevel >= 3:
+        for i in range(opd.shape[0]):
+            print('pssn = %10.8e/%10.8e = %6.4f' % (pss[i], pssa[i],
+                                                    pss[i] / pssa[i]))
+
+    return psfe, psftot, pss, pssa, mtfa
+
+
+def fwhmStack(opd, psftot, mtfa, wlum, D=8.36, fwhm_thresh=0.01, power=2,
+              workers=-1):
+    """
+    psf2FWHMring() with type='opd', in mas, for a (nOPD, m, m) stack of
+    OPDs whose error + atmosphere PSFs psftot and atmosphere MTF mtfa
+    come from pssnStackTerms().
+    """
+    psft = opd2psfStack(np.zeros(opd.shape), wlum, pupil=(opd != 0),
+                        workers=workers)
+    fwhmatm = psf2FWHMringStack(psfConvolveMTF(psft, mtfa, workers=workers),
+                                wlum, D, fwhm_thresh)
+    fwhmtot = psf2FWHMringStack(psftot, wlum, D, fwhm_thresh)
+    # cannot be negative
+    return np.maximum(0, fwhmtot**power - fwhmatm**power)**(1 / power)
+
+
+def psf2FWHMringStack(psf, wlum, D=8.36, fwhm_thresh=0.01):
+    """
+    Twice the mean distance, in mas, between the peak and the pixels within
+    fwhm_thresh of half maximum, as in psf2FWHMring(), for each PSF of a
+    (nPSF, m, m) stack sampled like calc_pssn() type='opd'.
+    """
+    m = psf.shape[-1]
+    conv = 206265000.  # =3600*180/pi*1000; radian to mas
+    da = conv * wlum * 1e-6 / D
+    ha = da * (m - 1) / 2
+    ha1d = np.linspace(-ha, ha, m)
+
+    fwhm = np.zeros(psf.shape[0])
+    for i in range(psf.shape[0]):
+        dm = np.max(psf[i])
+        iy, ix = np.unravel_index(np.argmax(psf[i]), psf[i].shape)
+        iyr, ixr = np.nonzero(np.abs(psf[i] - 0.5 * dm) < fwhm_thresh * dm)
+        fwhm[i] = 2 * np.mean(np.sqrt((ha1d[ixr] - ha1d[ix])**2 +
+                                      (ha1d[iyr] - ha1d[iy])**2))
+    return fwhm
+
+
+def getReferencePSS(iad, wlum, imagedelta, fno, D, m, k, zen, r0inmRef,
+                    debugLevel=0, cacheDir=None):
+    """
+    The reference terms of calc_pssn(): the atmosphere MTF, the PSS of a
+    perfect telescope with pupil iad under that atmosphere, and the sum of
+    the perfect telescope PSF.
+    They don't depend on the wavefront error, so they are kept in memory
+    (least recently used dropped beyond maxReferencePSS) and in the
+    ArtifactCache of cacheDir, where other fields, worker processes and
+    iterations can pick them up. The MTF, the large one, is kept once for
+    all pupils, see getAtmosphereMTF().
+    cacheDir=None uses getCacheDir(); cacheDir='' keeps them in memory only.
+    """
+    mtfa = getAtmosphereMTF(D, m, k, wlum, zen, r0inmRef, cacheDir)
+    key = arrayKey('pssa', np.asarray(iad), wlum, imagedelta, fno, D, m, k,
+                   zen, r0inmRef)
+    if key in _referencePSS:
+        _referencePSS.move_to_end(key)
+        return (mtfa,) + _referencePSS[key]
+
+    store = ArtifactCache(cacheDir)
+    aa = store.getArrays(key)
+    if aa is not None:
+        pssa = float(aa['pssa'])
+        psftSum = float(aa['psftSum'])
+    else:
+        opdt = np.zeros((m, m))
+        psft = opd2psf(opdt, iad, wlum, imagedelta, 1, fno, debugLevel)
+        otft = psf2otf(psft)  # OTF of perfect telescope
+        otfa = otft * mtfa  # add atmosphere to perfect telescope
+        psfa = otf2psf(otfa)
+        pssa = np.sum(psfa**2)  # atmospheric PSS = 1/neff_atm
+        psftSum = np.sum(psft)
+        store.putArrays(key, pssa=pssa, psftSum=psftSum)
+
+    _referencePSS[key] = (pssa, psftSum)
+    while len(_referencePSS) > maxReferencePSS:
+        _referencePSS.popitem(last=False)
+    return (mtfa,) + _referencePSS[key]
+
+
+def getAtmosphereMTF(D, m, k, wlum, zen, r0inmRef, cacheDir=None):
+    """
+    createMTFatm(), kept in memory (least recently used dropped beyond
+    maxAtmosphereMTF) and in the ArtifactCache of cacheDir, like
+    getReferencePSS(). Read-only, it is shared by every caller.
+    """
+    key = arrayKey('mtfa', D, m, k, wlum, zen, r0inmRef)
+    if key in _atmosphereMTF:
+        _atmosphereMTF.move_to_end(key)
+        return _atmosphereMTF[key]
+
+    store = ArtifactCache(cacheDir)
+    aa = store.getArrays(key)
+    if aa is not None:
+        mtfa = aa['mtfa']
+    else:
+        mtfa = createMTFatm(D, m, k, wlum, zen, r0inmRef)
+        store.putArrays(key, mtfa=mtfa)
+
+    mtfa.setflags(write=False)
+    _atmosphereMTF[key] = mtfa
+    while len(_atmosphereMTF) > maxAtmosphereMTF:
+        _atmosphereMTF.popitem(last=False)
+    return mtfa
+
+
+def createMTFatm(D, m, k, wlum, zen, r0inmRef, model='vonK', L0=30,
+                 fast=False):
     """
     m is the number of pixel we want to have to cover the length of D.
     If we want a k-times bigger array, we pad the mtf generated using k=1.
+    fast=True pads to the next fast FFT size instead, the same as
+    opd2psfStack(fast=True); the frequency grid stays D/(m-1) per pixel.
     """
 
-    sfa = atmSF('vonK', D, m, wlum, zen, r0inmRef)
+    sfa = atmSF(model, D, m, wlum, zen, r0inmRef, L0)
     mtfa = np.exp(-0.5 * sfa)
 
-    N = int(m + np.rint((m * (k - 1) + 1e-5) / 2) * 2)  # add even number
-    mtfa = padArray(mtfa, N)
+    N = padSize(m, k, fast)
+    mtfa = padStack(mtfa, N)
 
     return mtfa
 
 
-def atmSF(model, D, m, wlum, zen, r0inmRef):
+@lru_cache(maxsize=32)
+def atmSF(model, D, m, wlum, zen, r0inmRef, L0=30):
     """
     create the atmosphere phase structure function
     model = 'Kolm'
              = 'vonK'
+    L0: outer scale in meter, only used when model=vonK
+    The structure function only depends on radius, so it is evaluated
+    once per distinct radius on the grid, then broadcast back to m x m.
+    The result is cached, and read-only.
     """
     r0a = r0Wz(r0inmRef, zen, wlum)
-    L0 = 30  # outer scale in meter, only used when model=vonK
 
     m0 = np.rint(0.5 * (m + 1) + 1e-5)
     aa = np.arange(1, m + 1)
     x, y = np.meshgrid(aa, aa)
 
     dr = D / (m - 1)  # frequency resolution in 1/rad
-    r = dr * np.sqrt((x - m0)**2 + (y - m0)**2)
+    # (x - m0)**2 + (y - m0)**2 only takes integer values
+    r2, inv = np.unique((x - m0)**2 + (y - m0)**2, return_inverse=True)
+    r = dr * np.sqrt(r2)
 
     if model == 'Kolm':
         sfa = 6.88 * (r / r0a)**(5 / 3)
@@ -484,15 +777,15 @@ def atmSF(model, D, m, wlum, zen, r0inmRef):
             (24 / 5 * sp.gamma(6 / 5))**(5 / 6) * (r0a / L0)**(-5 / 3)
         # modified bessel of 2nd/3rd kind
         sfa_k = sp.kv(5 / 6, (2 * np.pi / L0 * r))
-        sfa = sfa_c * (2**(-1 / 6) * sp.gamma(5 / 6) -
-                       (2 * np.pi / L0 * r)**(5 / 6) * sfa_k)
+        with np.errstate(invalid='ignore'):
+            sfa = sfa_c * (2**(-1 / 6) * sp.gamma(5 / 6) -
+                           (2 * np.pi / L0 * r)**(5 / 6) * sfa_k)
 
         # if we don't do below, everything will be nan after ifft2
-        # midp = r.shape[0]/2+1
-        # 1e-2 is to avoid x.49999 be rounded to x
-        midp = int(np.rint(0.5 * (r.shape[0] - 1) + 1e-2))
-        sfa[midp, midp] = 0  # at this single point, sfa_k=Inf, 0*Inf=Nan;
+        sfa[r2 == 0] = 0  # at this single point, sfa_k=Inf, 0*Inf=Nan;
 
+    sfa = sfa[inv].reshape(x.shape)
+    sfa.setflags(write=False)
     return sfa
 
 
@@ -534,6 +827,36 @@ def psf2eAtmW(array, wlum, type='opd', D=8.36, pmask=0, r0inmRef=0.1382,
     return e, q11, q22, q12
 
 
+def psf2eAtmWStack(opd, wlum, D=8.36, r0inmRef=0.1382, sensorFactor=1,
+                   zen=0, imagedelta=0.2, fno=1.2335, fast=False, workers=-1,
+                   debugLevel=0):
+    """
+    psf2eAtmW() with type='opd' on a (nOPD, m, m) stack of wavefront OPDs
+    in micron at one wavelength, with stacked FFTs on workers threads.
+    fast=True pads the FFTs to the next fast size (see aosFFT.padSize());
+    the PSF pixels get smaller, and the weighting function of psf2eW()
+    follows them. Ellipticities change by about 1e-5 or less, see
+    benchmarkFFT.py.
+    Returns the ellipticity of each, (nOPD,).
+    """
+    k = fno * wlum / imagedelta
+    m = opd.shape[-1] / sensorFactor
+    psfe = opd2psfStack(opd, wlum, imagedelta=imagedelta,
+                        sensorFactor=sensorFactor, fno=fno, fast=fast,
+                        workers=workers)
+    mtfa = createMTFatm(D, m, k, wlum, zen, r0inmRef, fast=fast)
+    psf = psfConvolveMTF(psfe, mtfa, workers=workers)
+    N0 = padSize(opd.shape[-1], k / sensorFactor)
+    imagedelta = imagedelta * N0 / psf.shape[-1]
+
+    if debugLevel >= 3:
+        print('Below from the Gaussian weigting function on elli')
+    elli = np.zeros(opd.shape[0])
+    for i in range(opd.shape[0]):
+        elli[i] = psf2eW(psf[i], imagedelta, wlum, 'Gau', debugLevel)[0]
+    return elli
+
+
 def psf2eW(psf, pixinum, wlum, atmModel, debugLevel=0):
 
     x, y = np.meshgrid(np.arange(1, psf.shape[0] + 1),
@@ -689,13 +1012,29 @@ def otf2psf(otf):
     return psf
 
 
+def readOPDStack(opdFile, opdx, opdy):
+    """
+    Read the OPD (in um) of each file in opdFile into a (nOPD, m, m) stack,
+    with piston, tip and tilt removed and zeros outside of the pupil, the
+    way runPSSNandMore() and runEllipticity() prepare them.
+    """
+    opd = []
+    for filename in opdFile:
+        IHDU = fits.open(filename)
+        opd.append(removePTT(IHDU[0].data, opdx, opdy))
+        IHDU.close()
+    return np.array(opd)
+
+
 def runEllipticity(argList):
+    """
+    argList is (inputFile, wavelength, debugLevel, pixelum); run on an
+    aosPool that has the opdx and opdy grids.
+    """
     inputFile = argList[0]
-    opdx = argList[1].opdx
-    opdy = argList[1].opdy
-    wavelength = argList[2]
-    debugLevel = argList[3]
-    pixelum = np.abs(argList[4])
+    wavelength = argList[1]
+    debugLevel = argList[2]
+    pixelum = np.abs(argList[3])
     print('runEllipticity: %s ' % inputFile)
 
     if pixelum == 0:
@@ -706,10 +1045,7 @@ def runEllipticity(argList):
         # before psf2eAtmW()
         # (1) remove PTT,
         # (2) make sure outside of pupil are all zeros
-        idx = (opd != 0)
-        Z = ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx], 3, 0)
-        Z[3:] = 0
-        opd[idx] -= ZernikeAnnularEval(Z, opdx[idx], opdy[idx], 0)
+        removePTT(opd, getShared('opdx'), getShared('opdy'))
 
         elli, _, _, _ = psf2eAtmW(
             opd, wavelength, debugLevel=debugLevel)
@@ -733,16 +1069,16 @@ def runEllipticity(argList):
 
 def runPSSNandMore(argList):
     """
+    argList is (inputFile, wavelength, debugLevel, pixelum); run on an
+    aosPool that has the opdx and opdy grids.
     pixelum = 0 means we use opd, meanwhile only opd is provided.
     pixelum !=0 means we use psf. both psf and pmask needs to be provided.
     """
 
     inputFile = argList[0]
-    opdx = argList[1].opdx
-    opdy = argList[1].opdy
-    wavelength = argList[2]
-    debugLevel = argList[3]
-    pixelum = np.abs(argList[4])
+    wavelength = argList[1]
+    debugLevel = argList[2]
+    pixelum = np.abs(argList[3])
     print('runPSSNandMore: %s ' % inputFile)
 
     if pixelum == 0:
@@ -753,10 +1089,7 @@ def runPSSNandMore(argList):
         # before calc_pssn,
         # (1) remove PTT,
         # (2) make sure outside of pupil are all zeros
-        idx = (opd != 0)
-        Z = ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx], 3, 0)
-        Z[3:] = 0
-        opd[idx] -= ZernikeAnnularEval(Z, opdx[idx], opdy[idx], 0)
+        removePTT(opd, getShared('opdx'), getShared('opdy'))
 
         pssn, fwhmeff = calc_pssn(opd, wavelength, debugLevel=debugLevel)
     else:
@@ -798,10 +1131,7 @@ def runFFTPSF(argList):
     #        in principle doesn't matter,
     # in practice, this affects centering, so it affects edge cutoff on psf)
     # (2) make sure outside of pupil are all zeros
-    idx = (opd != 0)
-    Z = ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx], 3, 0)
-    Z[3:] = 0
-    opd[idx] -= ZernikeAnnularEval(Z, opdx[idx], opdy[idx], 0)
+    removePTT(opd, opdx, opdy)
 
     psf = opd2psf(opd, 0, wavelength, imagedelta, sensorfactor,
                   fno, debugLevel)
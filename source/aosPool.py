@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# arrays and constants of the pool, as the task functions see them
+_shared = {}
+# shared memory blocks this process has mapped, kept open with _shared
+_blocks = []
+
+
+def initWorker(arrays, constants):
+    """
+    Pool initializer: map each shared memory block as a read-only array,
+    and keep the constants, all under their names in _shared.
+    arrays is {name: (block name, shape, dtype)}.
+    """
+    for name, (blockName, shape, dtype) in arrays.items():
+        block = shared_memory.SharedMemory(name=blockName)
+        _blocks.append(block)
+        a = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        a.setflags(write=False)
+        _shared[name] = a
+    _shared.update(constants)
+
+
+def getShared(name):
+    """a constant grid or object given to aosPool, inside a task function"""
+    return _shared[name]
+
+
+def runTask(args):
+    i, func, task = args
+    return i, func(task)
+
+
+class aosPool(object):
+    """
+    numproc worker processes that live for the whole run, instead of a new
+    multiprocessing.Pool for every step.
+    arrays (e.g. opdx, opdy) go into shared memory once, constants (e.g.
+    the cwfs Algorithm and Instrument) get pickled once per worker; task
+    functions look them up with getShared(), so tasks only carry file names
+    and other small arguments.
+    With numproc <= 1, or on MacOS, where multiprocessing doesn't work with
+    pinv, tasks run in this process.
+    """
+
+    def __init__(self, numproc, arrays=None, constants=None):
+        self.numproc = numproc
+        self.blocks = []
+        self.pool = None
+        self.names = []
+        if arrays is None:
+            arrays = {}
+        if constants is None:
+            constants = {}
+
+        if numproc <= 1 or sys.platform == 'darwin':
+            # read-only views, as the workers get them; close() drops them
+            for name, a in arrays.items():
+                a = np.asarray(a).view()
+                a.setflags(write=False)
+                _shared[name] = a
+            _shared.update(constants)
+            self.names = list(arrays) + list(constants)
+            return
+
+        handles = {}
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(a.nbytes, 1))
+            np.ndarray(a.shape, dtype=a.dtype, buffer=block.buf)[...] = a
+            self.blocks.append(block)
+            handles[name] = (block.name, a.shape, a.dtype.str)
+        self.pool = multiprocessing.Pool(numproc, initializer=initWorker,
+                                         initargs=(handles, constants))
+
+    def map(self, func, tasks, chunksize=None):
+        """
+        [func(task) for task in tasks], with the tasks dispatched through
+        imap_unordered() in chunks and the results put back in order.
+        func needs to be a module-level function.
+        """
+        tasks = list(tasks)
+        if self.pool is None:
+            return [func(task) for task in tasks]
+
+        if chunksize is None:
+            chunksize = max(1, len(tasks) // (4 * self.numproc))
+        out = [None] * len(tasks)
+        for i, result in self.pool.imap_unordered(
+                runTask, [(i, func, task) for i, task in enumerate(tasks)],
+                chunksize):
+            out[i] = result
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        for name in self.names:
+            _shared.pop(name, None)
+        self.names = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
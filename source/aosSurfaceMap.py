@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+from scipy import linalg
+
+from aosCache import arrayKey, saveCache, saveCacheArray, ArtifactCache
+
+# operators already built in this process, keyed by RbfGridOperator.key,
+# the last maxOperators used (M1, M3 and M2 in a run).
+# Their LU factors (N^2 doubles, 660 MB for M2) are memory-mapped from the
+# cache, so all the aosPool workers share one copy; with cacheDir=''
+# each process has its own.
+_operators = OrderedDict()
+maxOperators = 3
+# on disk, the least recently used are removed beyond AOS_RBF_MB
+maxRbfBytes = int(os.environ.get('AOS_RBF_MB', 4096)) * 2**20
+
+
+class RbfGridOperator(object):
+    """
+    Linear operator from surface values on a fixed set of FEA nodes to the
+    (z, dz/dx, dz/dy, d2z/dxdy) maps on the Zemax/PhoSim surface grid.
+
+    This is the same multiquadric interpolation that scipy.interpolate.Rbf
+    does with its default arguments. The RBF system only depends on the
+    node coordinates, so it is factorized once; afterwards each surface map
+    costs one lu_solve and a few matrix-vector products.
+    Derivatives are evaluated analytically instead of by finite differences.
+    """
+
+    def __init__(self, xf, yf, innerR, outerR, nx, ny, lu=None, piv=None):
+        self.xf = np.asarray(xf, dtype=np.float64).flatten()
+        self.yf = np.asarray(yf, dtype=np.float64).flatten()
+        self.innerR = innerR
+        self.outerR = outerR
+        self.nx = nx
+        self.ny = ny
+        self.N = self.xf.shape[0]
+
+        # default epsilon of scipy Rbf, "the average distance between nodes"
+        edges = np.array([np.ptp(self.xf), np.ptp(self.yf)])
+        edges = edges[np.nonzero(edges)]
+        self.epsilon = np.power(np.prod(edges) / self.N, 1.0 / edges.size)
+
+        self.setGrid()
+
+        if lu is None:
+            dx = self.xf[:, None] - self.xf[None, :]
+            dy = self.yf[:, None] - self.yf[None, :]
+            A = np.sqrt((dx**2 + dy**2) / self.epsilon**2 + 1)
+            lu, piv = linalg.lu_factor(A, overwrite_a=True)
+        self.lu = lu
+        self.piv = piv
+
+    def setGrid(self):
+        # do not want to cover the edge? change 4->2 on both lines
+        self.NUM_X_PIXELS = self.nx + 4  # alway extend 2 points on each side
+        self.NUM_Y_PIXELS = self.ny + 4
+
+        # spatial extension factor
+        extFx = (self.NUM_X_PIXELS - 1) / (self.nx - 1)
+        extFy = (self.NUM_Y_PIXELS - 1) / (self.ny - 1)
+        extFr = np.sqrt(extFx * extFy)
+
+        self.delx = self.outerR * 2 * extFx / (self.NUM_X_PIXELS - 1)
+        self.dely = self.outerR * 2 * extFy / (self.NUM_Y_PIXELS - 1)
+
+        self.minx = -0.5 * (self.NUM_X_PIXELS - 1) * self.delx
+        self.miny = -0.5 * (self.NUM_Y_PIXELS - 1) * self.dely
+
+        # rows go with y, columns with x, in the order the file is written
+        x = self.minx + np.arange(self.NUM_Y_PIXELS) * self.delx
+        y = self.miny + np.arange(self.NUM_X_PIXELS) * self.dely
+        y = -y  # invert top to bottom, because Zemax reads (-x,-y) first
+        xg, yg = np.meshgrid(x, y)
+        xg = xg.flatten()
+        yg = yg.flatten()
+        r = np.sqrt(xg**2 + yg**2)
+        self.idx = ~((r < self.innerR / extFr) | (r > self.outerR * extFr))
+        self.xg = xg[self.idx]
+        self.yg = yg[self.idx]
+
+    @property
+    def key(self):
+        return operatorKey(self.xf, self.yf, self.innerR, self.outerR,
+                           self.nx, self.ny)
+
+    def weights(self, zf):
+        return linalg.lu_solve((self.lu, self.piv), zf)
+
+    def apply(self, zf, blockSize=2**24):
+        """
+        zf can be one surface (N,) or a stack of surfaces (N, nSurf).
+        Returns z, dx, dy, dxdy, each (NUM_X_PIXELS*NUM_Y_PIXELS,) or
+        (NUM_X_PIXELS*NUM_Y_PIXELS, nSurf), in the order gridSamp writes them.
+        Outside of the annulus everything is zero.
+        The evaluation matrices are built blockSize elements at a time.
+        """
+        w = self.weights(zf)
+        eps2 = self.epsilon**2
+        nOut = self.NUM_X_PIXELS * self.NUM_Y_PIXELS
+        out = np.zeros((4, nOut) + w.shape[1:])
+        res = np.zeros((4, self.xg.shape[0]) + w.shape[1:])
+        nRow = max(1, int(blockSize / self.N))
+        for i in range(0, self.xg.shape[0], nRow):
+            dx = self.xg[i:i + nRow, None] - self.xf[None, :]
+            dy = self.yg[i:i + nRow, None] - self.yf[None, :]
+            s = np.sqrt((dx**2 + dy**2) / eps2 + 1)
+            res[0, i:i + nRow] = s.dot(w)
+            s = 1 / s
+            dx *= s
+            dy *= s
+            res[1, i:i + nRow] = dx.dot(w) / eps2
+            res[2, i:i + nRow] = dy.dot(w) / eps2
+            dx *= dy
+            dx *= s
+            res[3, i:i + nRow] = -dx.dot(w) / eps2**2
+        out[:, self.idx] = res
+        return out[0], out[1], out[2], out[3]
+
+    def save(self, filename):
+        """
+        filename (.npz) with everything but the LU factor, which goes to
+        getLUFile(filename) (.npy), so that load() can memory-map it
+        """
+        saveCacheArray(getLUFile(filename), self.lu)
+        saveCache(filename, xf=self.xf, yf=self.yf,
+                  grid=np.array([self.innerR, self.outerR, self.nx, self.ny]),
+                  piv=self.piv)
+
+    @classmethod
+    def load(cls, filename):
+        aa = np.load(filename)
+        innerR, outerR, nx, ny = aa['grid']
+        return cls(aa['xf'], aa['yf'], innerR, outerR, int(nx), int(ny),
+                   lu=np.load(getLUFile(filename), mmap_mode='r'),
+                   piv=aa['piv'])
+
+
+def getLUFile(filename):
+    return filename.replace('.npz', '_lu.npy')
+
+
+def operatorKey(xf, yf, innerR, outerR, nx, ny):
+    return arrayKey(np.asarray(xf, dtype=np.float64),
+                    np.asarray(yf, dtype=np.float64),
+                    '%.9E %.9E %d %d' % (innerR, outerR, nx, ny))
+
+
+def getRbfGridOperator(xf, yf, innerR, outerR, nx, ny, cacheDir=None):
+    """
+    Get the RbfGridOperator for this node set and grid, building it only when
+    it is neither in memory nor on disk, in the 'rbf' ArtifactCache store.
+    cacheDir=None uses getCacheDir(); cacheDir='' keeps it in memory only.
+    """
+    key = operatorKey(xf, yf, innerR, outerR, nx, ny)
+    if key in _operators:
+        _operators.move_to_end(key)
+        return _operators[key]
+
+    store = ArtifactCache(cacheDir, maxBytes=maxRbfBytes, store='rbf')
+    names = ['rbf.npz', getLUFile('rbf.npz')]
+    op = None
+    entryDir = store.getEntry(key, names)
+    if entryDir is not None:
+        try:
+            op = RbfGridOperator.load('%s/rbf.npz' % entryDir)
+        except (OSError, ValueError):
+            pass  # evicted by another process meanwhile
+    if op is None:
+        op = RbfGridOperator(xf, yf, innerR, outerR, nx, ny)
+        if store.storeDir:
+            tmpDir = '%s/%s.%d.rbf.tmp' % (store.storeDir, key, os.getpid())
+            op.save('%s/rbf.npz' % tmpDir)
+            store.put(key, {name: '%s/%s' % (tmpDir, name)
+                            for name in names})
+            shutil.rmtree(tmpDir)
+            entryDir = store.getEntry(key, names)
+            if entryDir is not None:
+                # drop our copy of the LU factor for the shared map
+                op = RbfGridOperator.load('%s/rbf.npz' % entryDir)
+    _operators[key] = op
+    while len(_operators) > maxOperators:
+        _operators.popitem(last=False)
+    return op
+
+
+def writeSurfaceMap(resFile, z, dx, dy, dxdy, nx, ny, delx, dely,
+                    sidecar=False):
+    """
+    Write a Zemax/PhoSim surface map: a header line with the grid size and
+    spacing, then one '%.9E %.9E %.9E %.9E' line of z, dz/dx, dz/dy, d2z/dxdy
+    per grid point. The whole body is formatted in one pass and written at
+    once.
+    sidecar=True also saves the (nx*ny, 4) array next to resFile as .npy,
+    so that readSurfaceMap() can memory-map it instead of parsing the text.
+    """
+    data = np.ascontiguousarray(np.vstack((z, dx, dy, dxdy)).T,
+                                dtype=np.float64)
+    body = ('%.9E %.9E %.9E %.9E\n' * data.shape[0]) % tuple(data.ravel().tolist())
+    with open(resFile, 'w', buffering=2**20) as outid:
+        outid.write('%d %d %.9E %.9E\n' % (nx, ny, delx, dely))
+        outid.write(body)
+
+    if sidecar:
+        np.save(getSidecarFile(resFile), data)
+
+
+def readSurfaceMap(resFile, mmap_mode='r'):
+    """
+    Returns the header (nx, ny, delx, dely) and the (nx*ny, 4) array of a
+    surface map written by writeSurfaceMap(). The .npy sidecar is used when
+    it is there and not older than the text file.
+    """
+    with open(resFile) as fid:
+        aa = fid.readline().split()
+    header = (int(aa[0]), int(aa[1]), float(aa[2]), float(aa[3]))
+
+    npyFile = getSidecarFile(resFile)
+    if (os.path.isfile(npyFile) and
+            os.path.getmtime(npyFile) >= os.path.getmtime(resFile)):
+        data = np.load(npyFile, mmap_mode=mmap_mode)
+    else:
+        data = np.loadtxt(resFile, skiprows=1).reshape((-1, 4))
+    return header, data
+
+
+def getSidecarFile(resFile):
+    return os.path.splitext(resFile)[0] + '.npy'
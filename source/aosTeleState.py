@@ -7,19 +7,27 @@ import os
 import shutil
 import glob
 import subprocess
-import multiprocessing
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 from astropy.io import fits
 from astropy.time import Time
 from astropy.time import TimeDelta
 import aosCoTransform as ct
-from scipy.interpolate import Rbf
+from aosSurfaceMap import getRbfGridOperator
+from aosSurfaceMap import writeSurfaceMap
+from aosSurfaceMap import getSidecarFile
+from aosZernike import fitOPDStack
+from aosZernike import getZernikeProjector
+from aosCache import getCacheDir, arrayKey, saveCacheArray
+from aosCache import ArtifactCache
+from aosDataBundle import loadData
+from aosCamDistortion import aosCamDistortion, distTypes
+from aosWatcher import aosOutputWatcher
+from aosIO import submitIO, readFile, writeFile, collectFile
 
-from lsst.cwfs.tools import ZernikeAnnularFit
-from lsst.cwfs.tools import ZernikeFit
-from lsst.cwfs.tools import ZernikeEval
 from lsst.cwfs.tools import extractArray
 
 import matplotlib.pyplot as plt
@@ -104,11 +112,12 @@ class aosTeleState(object):
                         # This is
                         # 90-block['altitude'].values[:100]/np.pi*180
                         aa = os.path.join('%s/../data/'% self.aosSrcDir, (aa + '.txt'))
-                        bb = np.loadtxt(aa).reshape((-1, 1))
+                        bb = loadData(aa).reshape((-1, 1))
                         assert bb.shape[0]>endIter
                         assert np.max(bb)<90
                         assert np.min(bb)>0
                         self.zAngle = bb[:endIter+1, 0]/ 180 * np.pi
+                        self.zAngleFile = aa
                 elif (line.startswith('camTB') and self.inst[:4] == 'lsst'):
                     #ignore this if it is comcam
                     self.camTB = float(line.split()[1])
@@ -143,6 +152,8 @@ class aosTeleState(object):
                     self.znPert = int(line.split()[1])
                 elif (line.startswith('surfaceGridN')):
                     self.surfaceGridN = int(line.split()[1])
+                elif (line.startswith('surfaceMapNpy')):
+                    self.surfaceMapNpy = bool(int(line.split()[1]))
                 elif (line.startswith('opd_size')):
                     self.opdSize = int(line.split()[1])
                     if self.opdSize % 2 == 0:
@@ -159,6 +170,8 @@ class aosTeleState(object):
         fid.close()
         
         self.iqBudget = self.iqBudget * 1e-3
+        if not hasattr(self, 'surfaceMapNpy'):
+            self.surfaceMapNpy = False
         self.fno = 1.2335
         k = self.fno * self.effwave / 0.2
         self.psfStampSize = int(self.opdSize +
@@ -204,12 +217,22 @@ class aosTeleState(object):
             print(self.opdGrid1d[-1])
             print(self.opdGrid1d[-2])
 
+        # zlist and residual maps, shared by sims with identical surfaces
+        self.pertCache = ArtifactCache()
+
+        # print through maps of each zenith angle seen so far
+        self.printthz = {}
+        if hasattr(self, 'zAngleFile'):
+            self.precomputePrintthz(M1M3)
+            self.precomputePrintthz(M2)
         if hasattr(self, 'zAngle'):
-            self.M1M3surf = M1M3.getPrintthz(self.zAngle[0])
+            self.M1M3surf = self.getPrintthz(M1M3, self.zAngle[0])
 
             # add 5% force error. This is for iter0 only
             u0 = M1M3.zf * np.cos(self.zAngle[0]) + M1M3.hf * np.sin(self.zAngle[0])
-            LUTforce = getLUTforce(self.zAngle[0] / np.pi * 180, M1M3.LUTfile)
+            # LUT forces for the whole zenith angle history, (nIter, nActuator)
+            self.LUTforce = M1M3.getLUTforce(self.zAngle / np.pi * 180)
+            LUTforce = self.LUTforce[0]
             np.random.seed(self.iSim)
             # if the error is a percentage error
             myu = (1+2*(np.random.rand(M1M3.nActuator)-0.5)
@@ -228,7 +251,7 @@ class aosTeleState(object):
                              ) * 1e6  # now in um
             
             # M2 (input data file in micron, so here things are also in micron)
-            self.M2surf = M2.getPrintthz(self.zAngle[0])
+            self.M2surf = self.getPrintthz(M2, self.zAngle[0]).copy()
 
         if hasattr(self, 'M1M3TBulk'):
 
@@ -252,51 +275,22 @@ class aosTeleState(object):
             pre_camR = 0
             pre_temp_cam = 0
             # andy uses mm everywhere. Same here.
-            self.getCamDistortionAll(self.zAngle[0], pre_elev, pre_camR, pre_temp_cam)
-
-    def getCamDistortionAll(self, zAngle, pre_elev, pre_camR, pre_temp_cam):
-        self.getCamDistortion(zAngle, 'L1RB', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L2RB', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'FRB', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L3RB', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'FPRB', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L1S1zer', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L2S1zer', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L3S1zer', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L1S2zer', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L2S2zer', pre_elev, pre_camR, pre_temp_cam)
-        self.getCamDistortion(zAngle, 'L3S2zer', pre_elev, pre_camR, pre_temp_cam)
-        
-    def getCamDistortion(self, zAngle, distType, pre_elev, pre_camR, pre_temp_cam):
-        dataFile = os.path.join('%s/../data/camera'% self.aosSrcDir, (distType + '.txt'))
-        data = np.loadtxt(dataFile, skiprows=1)
-        distortion = data[0, 3:] * np.cos(zAngle) +\
-            (data[1, 3:] * np.cos(self.camRot) +
-             data[2, 3:] * np.sin(self.camRot)) * np.sin(zAngle)
-        # pre-compensation
-        distortion -= data[0, 3:] * np.cos(pre_elev) +\
-            (data[1, 3:] * np.cos(pre_camR) +
-             data[2, 3:] * np.sin(pre_camR)) * np.sin(pre_elev)
-
-        # simple temperature interpolation/extrapolation
-        if self.camTB < data[3, 2]:
-            distortion += data[3, 3:]
-        elif self.camTB > data[10, 2]:
-            distortion += data[10, 3:]
-        else:
-            p2 = (data[3:, 2] > self.camTB).argmax() + 3
-            p1 = p2 - 1
-            w1 = (data[p2, 2] - self.camTB) / (data[p2, 2] - data[p1, 2])
-            w2 = (self.camTB - data[p1, 2]) / (data[p2, 2] - data[p1, 2])
-            distortion += w1 * data[p1, 3:] + w2 * data[p2, 3:]
-
-        distortion -= data[(data[3:, 2] == pre_temp_cam).argmax() + 3, 3:]
-        # Andy's Zernike order is different, fix it
-        if distType[-3:] == 'zer':
-            zidx = [1, 3, 2, 5, 4, 6, 8, 9, 7, 10, 13, 14, 12, 15, 11, 19,
-                    18, 20, 17, 21, 16, 25, 24, 26, 23, 27, 22, 28]
-            distortion = distortion[[x - 1 for x in zidx]]
-        setattr(self, distType, distortion)
+            # distortions for the whole zenith angle history, so update()
+            # only has to pick the current one
+            self.camDist = aosCamDistortion()
+            self.camDistortion = self.camDist.evaluate(
+                self.zAngle, self.camRot, self.camTB, pre_elev, pre_camR,
+                pre_temp_cam)
+            self.setCamDistortion(0)
+
+    def setCamDistortion(self, iIter):
+        """
+        L1RB, ..., L3S2zer: the camera distortions at the zenith angle of
+        iteration iIter, from self.camDistortion
+        """
+        for i, distType in enumerate(distTypes):
+            setattr(self, distType, self.camDistortion[
+                iIter, i, :self.camDist.nCol[distType]])
 
     def update(self, esti, ctrl, M1M3=None, M2=None):
         self.stateV += ctrl.uk
@@ -305,25 +299,33 @@ class aosTeleState(object):
             raise RuntimeError("ERROR: stateV[%d] = %e > its range = %e" % (
                 ii, self.stateV[ii], ctrl.range[ii]))
 
-        # elevation is changing, the print through maps need to change
+        # elevation is changing, the print through maps need to change.
+        # The changes from one iteration to the next add up to
+        # P(zAngle[iIter]) - P(zAngle[0])
         if hasattr(self, 'M1M3surf'):
-            self.M1M3surf = self.M1M3surf0.copy()
-            for i in range(self.iIter):
-                self.M1M3surf += (M1M3.getPrintthz(self.zAngle[i+1]) -\
-                M1M3.getPrintthz(self.zAngle[i]))*1e6 #turn meter into micron
+            self.M1M3surf = self.M1M3surf0 + (
+                self.getPrintthz(M1M3, self.zAngle[self.iIter]) -
+                self.getPrintthz(M1M3, self.zAngle[0]))*1e6 #turn meter into micron
             _, _, self.M1M3surf = ct.M1CRS2ZCRS(0, 0, self.M1M3surf)
         if hasattr(self, 'M2surf'):
-            self.M2surf = self.M2surf0.copy()
-            for i in range(self.iIter):
-                self.M2surf += M2.getPrintthz(self.zAngle[i+1]) -\
-                  M2.getPrintthz(self.zAngle[i])
+            self.M2surf = self.M2surf0 + (
+                self.getPrintthz(M2, self.zAngle[self.iIter]) -
+                self.getPrintthz(M2, self.zAngle[0]))
             _, _, self.M2surf = ct.M2CRS2ZCRS(0, 0, self.M2surf)
 
+        # so are the camera distortions
+        if hasattr(self, 'camDistortion'):
+            self.setCamDistortion(self.iIter)
+
         if hasattr(self, 'brokenM1M3ActID'):
             if self.iIter >= self.brokenM1M3ActIter:
                 #what is the force that this actuator is expected to output
-                fWantedLUT = M1M3.zf[:M1M3.nzActuator] * np.cos(self.zAngle[self.iIter]) +\
-                M1M3.hf[:M1M3.nzActuator] * np.sin(self.zAngle[self.iIter])
+                if not hasattr(self, 'fWantedLUT'):
+                    # for the whole zenith angle history, (nIter, nzActuator)
+                    self.fWantedLUT = np.outer(
+                        np.cos(self.zAngle), M1M3.zf[:M1M3.nzActuator]) + \
+                        np.outer(np.sin(self.zAngle), M1M3.hf[:M1M3.nzActuator])
+                fWantedLUT = self.fWantedLUT[self.iIter]
                 bendMag = np.tile(self.stateV[esti.nB13Start:esti.nB13Start+esti.nB13Max],(M1M3.nzActuator,1))
                 fWanted = fWantedLUT + np.sum(bendMag*(M1M3.force[:,:esti.nB13Max]),axis=1)
                 np.savetxt(self.M1M3fWanted, np.vstack((M1M3.actID,fWantedLUT, fWanted-fWantedLUT, fWanted)).T)
@@ -331,6 +333,45 @@ class aosTeleState(object):
                     # (-1) below is b/c the UL shapes are for 1000N push, now gravity is pulling down
                     self.M1M3surf -= M1M3.getFBshape(self.brokenM1M3ActID, fWanted)*1e6 #turn meter into micron
 
+    def getPrintthz(self, mirror, zAngle):
+        """
+        mirror.getPrintthz(zAngle) for M1M3 or M2, computed once per zenith
+        angle. The maps are shared, so they are read-only.
+        """
+        key = (type(mirror).__name__, zAngle)
+        if key not in self.printthz:
+            printthz = mirror.getPrintthz(zAngle)
+            printthz.setflags(write=False)
+            self.printthz[key] = printthz
+        return self.printthz[key]
+
+    def precomputePrintthz(self, mirror, cacheDir=None):
+        """
+        Print through maps of M1M3 or M2 for the whole zAngle history, done
+        as one mirror.getPrintthzStack(). The (nIter, nNode) cube is saved
+        in the cache directory and memory-mapped, so sims with the same
+        history share it; its rows go into self.printthz.
+        cacheDir=None uses getCacheDir(); cacheDir='' keeps it in memory only.
+        """
+        name = type(mirror).__name__
+        if cacheDir is None:
+            cacheDir = getCacheDir()
+        key = arrayKey(self.zAngle, *[getattr(mirror, a, None) for a in (
+            'bx', 'by', 'nodeID', 'zdx', 'zdy', 'zdz', 'hdx', 'hdy', 'hdz')])
+        cacheFile = '%s/printthz_%s_%s.npy' % (cacheDir, name, key)
+
+        if cacheDir and os.path.isfile(cacheFile):
+            cube = np.load(cacheFile, mmap_mode='r')
+        else:
+            cube = mirror.getPrintthzStack(self.zAngle)
+            if cacheDir:
+                saveCacheArray(cacheFile, cube)
+                cube = np.load(cacheFile, mmap_mode='r')
+            else:
+                cube.setflags(write=False)
+        for i in range(self.zAngle.shape[0]):
+            self.printthz[(name, self.zAngle[i])] = cube[i]
+
     def getPertFilefromBase(self, baserun):
         
         if not os.path.isfile(self.pertFile):
@@ -367,7 +408,22 @@ class aosTeleState(object):
                 'sim%d' % self.iSim, 'sim%d' % baserun)
             os.link(baseFile, self.resFile2)
 
-    def writePertFile(self, ndofA, M1M3=None, M2=None):
+    def getPertArtifacts(self, **files):
+        """
+        {name: path} of the files writeM1M3zres()/writeM2zres() make,
+        with the .npy sidecars of the surface maps when surfaceMapNpy
+        """
+        if self.surfaceMapNpy:
+            for name in [name for name in files if name[:3] == 'res']:
+                files[name + 'npy'] = getSidecarFile(files[name])
+        return files
+
+    def writePertFile(self, ndofA, M1M3=None, M2=None, pool=None,
+                      debugLevel=0):
+        """
+        The surface maps (M1, M3, M2) are made in pool (an aosPool),
+        when given, all at once.
+        """
         fid = open(self.pertFile, 'w')
         for i in range(ndofA):
             if (self.stateV[i] != 0):
@@ -380,13 +436,24 @@ class aosTeleState(object):
         np.savetxt(self.pertMatFile, self.stateV)
 
         fid = open(self.pertCmdFile, 'w')        
+        jobs = []
+        # artifacts to store once their surface maps are done
+        toStore = []
         if hasattr(self, 'M1M3surf'):
             # M1M3surf already converted into ZCRS
-            writeM1M3zres(self.M1M3surf, M1M3.bx, M1M3.by, M1M3.Ri,
+            files = self.getPertArtifacts(
+                zlist=self.M1M3zlist, res1=self.resFile1, res3=self.resFile3)
+            key = arrayKey('M1M3', self.M1M3surf, M1M3.bx, M1M3.by,
+                           M1M3.nodeID, M1M3.Ri, M1M3.R, M1M3.R3i, M1M3.R3,
+                           self.znPert, self.surfaceGridN, sorted(files))
+            if not self.pertCache.get(key, files):
+                writeM1M3zres(self.M1M3surf, M1M3.bx, M1M3.by, M1M3.Ri,
                               M1M3.R, M1M3.R3i, M1M3.R3, self.znPert, 
                               self.M1M3zlist, self.resFile1,
                               self.resFile3, M1M3.nodeID,
-                              self.surfaceGridN)
+                              self.surfaceGridN, self.surfaceMapNpy,
+                              M1M3.getZernikeProjector(self.znPert), jobs)
+                toStore.append((key, files))
             zz = np.loadtxt(self.M1M3zlist)
             for i in range(self.znPert):
                 fid.write('izernike 0 %d %s\n' % (i, zz[i] * 1e-3))
@@ -398,10 +465,17 @@ class aosTeleState(object):
             
         if hasattr(self, 'M2surf'):
             # M2surf already converted into ZCRS
-            writeM2zres(self.M2surf, M2.bx, M2.by, M2.R, M2.Ri,
+            files = self.getPertArtifacts(zlist=self.M2zlist,
+                                          res2=self.resFile2)
+            key = arrayKey('M2', self.M2surf, M2.bx, M2.by, M2.R, M2.Ri,
+                           self.znPert, self.surfaceGridN, sorted(files))
+            if not self.pertCache.get(key, files):
+                writeM2zres(self.M2surf, M2.bx, M2.by, M2.R, M2.Ri,
                             self.znPert, self.M2zlist,
                             self.resFile2,
-                            self.surfaceGridN)
+                            self.surfaceGridN, self.surfaceMapNpy,
+                            M2.getZernikeProjector(self.znPert), jobs)
+                toStore.append((key, files))
             zz = np.loadtxt(self.M2zlist)
             for i in range(self.znPert):
                 fid.write('izernike 1 %d %s\n' % (i, zz[i] * 1e-3))
@@ -416,6 +490,11 @@ class aosTeleState(object):
                 fid.write('izernike 6 %d %s\n' % (i, self.L2S2zer[i]))
                 fid.write('izernike 9 %d %s\n' % (i, self.L3S1zer[i]))
                 fid.write('izernike 10 %d %s\n' % (i, self.L3S2zer[i]))
+
+        # the camera lenses are Zernikes only, no surface maps to make
+        runGridSampJobs(jobs, pool, debugLevel)
+        for key, files in toStore:
+            self.pertCache.put(key, files)
                 
         fid.close()
         
@@ -424,6 +503,9 @@ class aosTeleState(object):
         self.timeIter = self.time0 + iIter*TimeDelta(39, format='sec')
         #leave last digit for wavelength
         self.obsID = 9000000 + self.iSim * 1000 + self.iIter * 10
+        # the OPD run gets its own obshistid, so that it doesn't share
+        # PhoSim work and output files with the WFS run
+        self.opdObsID = self.obsID + 1
         self.pertFile = '%s/iter%d/sim%d_iter%d_pert.txt' % (
             self.pertDir, self.iIter, self.iSim, self.iIter)
         self.pertCmdFile = '%s/iter%d/sim%d_iter%d_pert.cmd' % (
@@ -439,6 +521,12 @@ class aosTeleState(object):
             self.imageDir, self.iIter, self.iSim, self.iIter)
         metr.elliFile = '%s/iter%d/sim%d_iter%d_elli.txt' % (
             self.imageDir, self.iIter, self.iSim, self.iIter)
+        metr.FWHMFile = '%s/iter%d/sim%d_iter%d_FWHM.txt' % (
+            self.imageDir, self.iIter, self.iSim, self.iIter)
+        metr.zPSSNFile = '%s/iter%d/sim%d_iter%d_zPSSN.txt' % (
+            self.imageDir, self.iIter, self.iSim, self.iIter)
+        metr.zFWHMFile = '%s/iter%d/sim%d_iter%d_zFWHM.txt' % (
+            self.imageDir, self.iIter, self.iSim, self.iIter)
         if wfs is not None:
             wfs.zFile = '%s/iter%d/sim%d_iter%d_E000.z4c' % (
                 self.imageDir, self.iIter, self.iSim, self.iIter)
@@ -505,26 +593,75 @@ class aosTeleState(object):
                 metr.GQFWHMeff = aa[1, -1]
 
     def getOPDAll(self, opdoff, metr, numproc, znwcs,
-                  obscuration, debugLevel):
-
+                  obscuration, debugLevel, nShard=1):
+        """
+        nShard > 1 splits the OPDs over that many PhoSim runs (at most 9,
+        each with its own obshistid), numproc/nShard threads each, all
+        running at once.
+        """
         if not opdoff:
-            self.writeOPDinst(metr)
+            shards = self.writeOPDinst(metr, nShard)
             self.writeOPDcmd(metr)
-            argList = []
-                    
-            srcFile = '%s/output/opd_%d.fits.gz' % (
-                self.phosimDir, self.obsID)
-            dstFile = '%s/iter%d/sim%d_iter%d_opd.fits.gz' % (
+            nOPD = metr.nFieldp4 * self.nOPDw
+
+            # PhoSim names the OPDs by obshistid and their number in the
+            # shard; put them back in the order of writeOPDinst(metr, 1)
+            srcFiles = [None] * nOPD
+            for _, _, obsID, ids in shards:
+                for j, i in enumerate(ids):
+                    srcFiles[i] = '%s/output/opd_%d_%d.fits.gz' % (
+                        self.phosimDir, obsID, j)
+                    if os.path.isfile(srcFiles[i]):
+                        os.remove(srcFiles[i])
+            dstFile = '%s/iter%d/sim%d_iter%d_opd.fits' % (
                 self.imageDir, self.iIter, self.iSim, self.iIter)
-
-            argList.append((self.OPD_inst, self.OPD_cmd, self.inst,
-                                self.eimage, self.OPD_log,
-                                self.phosimDir,
-                                self.zTrueFile, metr.nFieldp4,
-                                znwcs, obscuration, self.opdx, self.opdy,
-                                srcFile, dstFile, self.nOPDw, numproc,
-                                debugLevel))
-            runOPD(argList[0])
+            dstFiles = []
+            for i in range(nOPD):
+                if self.nOPDw == 1:
+                    dstFiles.append(dstFile.replace('opd', 'opd%d' % i))
+                else:
+                    dstFiles.append(dstFile.replace('opd', 'opd%d_w%d' % (
+                        i % metr.nFieldp4, int(i / metr.nFieldp4))))
+
+            # each OPD is read and fitted as soon as PhoSim has written
+            # it; the unzipped copies are written in the I/O pool
+            Z = np.zeros((nOPD, znwcs))
+            index = dict(zip(srcFiles, range(nOPD)))
+            writes = []
+
+            def claim(srcFile):
+                i = index[srcFile]
+                Z[i] = collectOPD(srcFile, dstFiles[i], self.opdx,
+                                  self.opdy, znwcs, obscuration, writes)
+            watcher = aosOutputWatcher(srcFiles, claim)
+
+            nthread = max(1, numproc // len(shards))
+            try:
+                with ThreadPoolExecutor(min(len(shards), numproc)) \
+                        as executor:
+                    list(executor.map(lambda shard: runPhosimOPD(
+                        shard[0], self.OPD_cmd, self.inst, self.eimage,
+                        shard[1], self.phosimDir, nthread, debugLevel),
+                                      shards))
+            finally:
+                claimed = watcher.finish()
+                for write in writes:
+                    write.result()
+            if len(shards) > 1:
+                with open(self.OPD_log, 'w') as fid:
+                    for shard in shards:
+                        with open(shard[1]) as flog:
+                            fid.write(flog.read())
+            if len(claimed) < nOPD:
+                raise RuntimeError('PhoSim did not write %s' % ', '.join(
+                    sorted(set(srcFiles) - set(claimed))))
+            np.savetxt(self.zTrueFile, Z, delimiter=' ')
+
+            if debugLevel >= 3:
+                print(self.opdx)
+                print(self.opdy)
+                print(znwcs)
+                print(obscuration)
             
     def getOPDAllfromBase(self, baserun, metr):
         if not os.path.isfile(self.OPD_inst):
@@ -563,10 +700,38 @@ class aosTeleState(object):
             os.link(baseFile, self.OPD_cmd)
 
 
-    def writeOPDinst(self, metr):
+    def writeOPDinst(self, metr, nShard=1):
+        """
+        Writes OPD_inst with all nOPDw * nFieldp4 OPDs. For nShard > 1
+        also writes one inst file per shard, with its own obshistid.
+        Returns [(inst file, log file, obshistid, OPD numbers)], one per
+        PhoSim run.
+        """
+        opds = []
+        for irun in range(self.nOPDw):
+            for i in range(metr.nFieldp4):
+                if self.nOPDw == 1:
+                    wavelength = self.effwave
+                else:
+                    wavelength = self.GQwave[self.band][irun]
+                opds.append((metr.fieldX[i], metr.fieldY[i],
+                             wavelength * 1e3))
+        nShard = max(1, min(nShard, 9, len(opds)))
+        shards = [(self.OPD_inst, self.OPD_log, self.opdObsID,
+                   list(range(len(opds))))]
+        if nShard > 1:
+            shards += [(self.OPD_inst.replace('.inst', '_s%d.inst' % k),
+                        self.OPD_log.replace('.log', '_s%d.log' % k),
+                        self.opdObsID + k, list(ids))
+                       for k, ids in enumerate(
+                           np.array_split(np.arange(len(opds)), nShard))]
 
-        fid = open(self.OPD_inst, 'w')
-        fid.write('rightascension 0\n\
+        fpert = open(self.pertFile, 'r')
+        pert = fpert.read()
+        fpert.close()
+        for instFile, _, obsID, ids in shards:
+            fid = open(instFile, 'w')
+            fid.write('rightascension 0\n\
 declination 0\n\
 rotskypos 0\n\
 rottelpos 0\n\
@@ -575,22 +740,13 @@ Opsim_obshistid %d\n\
 SIM_VISTIME 15.0\n\
 SIM_NSNAP 1\n\
 altitude 90\n\
-azimuth 0\n' % (phosimFilterID[self.band], self.obsID))
-        fpert = open(self.pertFile, 'r')
-        fid.write(fpert.read())
-        for irun in range(self.nOPDw):
-            for i in range(metr.nFieldp4):
-                if self.nOPDw == 1:
-                    fid.write('opd %2d\t%9.6f\t%9.6f %5.1f\n' % (
-                        i, metr.fieldX[i], metr.fieldY[i],
-                        self.effwave * 1e3))
-                else:
-                    fid.write('opd %2d\t%9.6f\t%9.6f %5.1f\n' % (
-                        irun * metr.nFieldp4 + i,
-                        metr.fieldX[i], metr.fieldY[i],
-                        self.GQwave[self.band][irun] * 1e3))
-        fid.close()
-        fpert.close()
+azimuth 0\n' % (phosimFilterID[self.band], obsID))
+            fid.write(pert)
+            for j, i in enumerate(ids):
+                fid.write('opd %2d\t%9.6f\t%9.6f %5.1f\n' % ((j,) + opds[i]))
+            fid.close()
+        # the full OPD_inst is only there for the record
+        return shards[1:] if nShard > 1 else shards
 
     def writeOPDcmd(self, metr):
         fid = open(self.OPD_cmd, 'w')
@@ -603,32 +759,96 @@ perturbationmode 1\n')
         fid.close()
 
     def getWFSAll(self, wfs, catalog, numproc, debugLevel):
-
-        self.writeWFSinst(wfs, catalog)
+        """
+        With a chip column in catalog (GridCatalog), each chip is its own
+        PhoSim job on its part of the catalog, numproc/nChip threads each,
+        with its own work and output directories. The images and centroid
+        files go to imageDir/iter# as soon as PhoSim has written them.
+        """
         self.writeWFScmd(wfs)
-        argList = [(self.WFS_inst, self.WFS_cmd, self.inst,
-                                self.eimage, self.WFS_log,
-                                self.phosimDir, numproc, debugLevel)]
-
-        pool = multiprocessing.Pool(numproc)
-        pool.map(runWFS1side, argList)
-        pool.close()
-        pool.join()
-
-        runProgram('gunzip -frq {}/output'.format(self.phosimDir))
-        src = glob.glob('%s/output/*%s_f%d_*' %
-                            (self.phosimDir, self.obsID,
-                            phosimFilterID[self.band]))
-        for s in src:
-            runProgram('mv -f %s %s/iter%d' %
-                (s, self.imageDir, self.iIter))
+        chipCatalogs = catalog.byChip()
+        if None in chipCatalogs:
+            self.writeWFSinst(wfs, catalog)
+            writes = []
+            watcher = self.watchWFS('%s/output' % self.phosimDir, writes)
+            # a single PhoSim job, which uses numproc itself
+            try:
+                runWFS1side((self.WFS_inst, self.WFS_cmd, self.inst,
+                             self.eimage, self.WFS_log,
+                             self.phosimDir, numproc, debugLevel, ''))
+            finally:
+                watcher.finish()
+                for write in writes:
+                    write.result()
+        else:
+            nproc = max(1, numproc // len(chipCatalogs))
+            jobs = {}
+            with ThreadPoolExecutor(min(len(chipCatalogs), numproc)) \
+                    as executor:
+                for chip, chipCatalog in chipCatalogs.items():
+                    shard = 'wfs%d_%s' % (self.obsID, chip)
+                    WFS_inst = self.WFS_inst.replace('.inst', '_%s.inst' % chip)
+                    WFS_log = self.WFS_log.replace('.log', '_%s.log' % chip)
+                    outputDir = '%s/output/%s' % (self.phosimDir, shard)
+                    workDir = '%s/work/%s' % (self.phosimDir, shard)
+                    for d in (outputDir, workDir):
+                        if os.path.isdir(d):
+                            shutil.rmtree(d)
+                        os.makedirs(d)
+                    self.writeWFSinst(wfs, chipCatalog, WFS_inst)
+                    # the shards have the same obshistid, so the file names
+                    # stay the same, but not the same work directory
+                    extraArgs = '-s "%s_C0|%s_C1" -w %s -o %s' % (
+                        chip, chip, workDir, outputDir)
+                    job = executor.submit(
+                        runWFS1side, (WFS_inst, self.WFS_cmd, self.inst,
+                                      self.eimage, WFS_log, self.phosimDir,
+                                      nproc, debugLevel, extraArgs))
+                    writes = []
+                    jobs[job] = (outputDir, workDir, writes,
+                                 self.watchWFS(outputDir, writes))
+                for job in as_completed(jobs):
+                    outputDir, workDir, writes, watcher = jobs[job]
+                    watcher.finish()
+                    for write in writes:
+                        write.result()
+                    job.result()
+                    shutil.rmtree(outputDir)
+                    shutil.rmtree(workDir)
+            with open(self.WFS_log, 'w') as fid:
+                for chip in chipCatalogs:
+                    with open(self.WFS_log.replace(
+                            '.log', '_%s.log' % chip)) as flog:
+                        fid.write(flog.read())
 
         if self.eimage:
             self.runIsr()
 
+    def watchWFS(self, outputDir, writes):
+        """
+        aosOutputWatcher that moves the images and centroid files of this
+        iteration in outputDir to imageDir/iter#, unzipped, in the I/O
+        pool; the futures are appended to writes
+        """
+        # only our own files, the OPD run may be writing there too
+        pattern = '%s/*%s_f%d_*' % (outputDir, self.obsID,
+                                    phosimFilterID[self.band])
+        dstDir = '%s/iter%d' % (self.imageDir, self.iIter)
+
+        def claim(path):
+            if path.endswith('.gz'):
+                # unzipped in the watcher, which tries a truncated one again
+                data = readFile(path)
+                dstFile = '%s/%s' % (dstDir, os.path.basename(path)[:-3])
+                writes.append(submitIO(writeFile, dstFile, data, path))
+            else:
+                writes.append(submitIO(collectFile, path, dstDir))
+        return aosOutputWatcher([pattern], claim)
 
-    def writeWFSinst(self, wfs, catalog):
-        fid = open(self.WFS_inst, 'w')
+    def writeWFSinst(self, wfs, catalog, WFS_inst=None):
+        if WFS_inst is None:
+            WFS_inst = self.WFS_inst
+        fid = open(WFS_inst, 'w')
         preamble = """rightascension 0
 declination 0
 rotskypos 0
@@ -706,12 +926,10 @@ centroidfile 1
         postISRDir = os.path.join(butlerDir, 'rerun', 'run1')
 
         if not os.path.exists(flatsDir):
-            cwd = os.getcwd()
             os.mkdir(flatsDir)
-            os.chdir(flatsDir)
+            # not os.chdir(): with -overlap this runs beside the OPD run
             runProgram('makeGainImages.py --detector_list R00_S22 R40_S02 R04_S20 R44_S00',
-                       verbose=True)
-            os.chdir(cwd)
+                       verbose=True, cwd=flatsDir)
 
         if os.path.exists(repackagedDir):
             shutil.rmtree(repackagedDir)
@@ -784,14 +1002,17 @@ centroidfile 1
                 header['WDIR%d' % ilayer]))
         fid.close()
 
-def runProgram(command, binDir=None, argstring=None, verbose=False):
+def runProgram(command, binDir=None, argstring=None, verbose=False,
+               cwd=None):
+    """runs command in a shell, in the directory cwd if given"""
     myCommand = command
     if binDir is not None:
         myCommand = os.path.join(binDir, command)
     if argstring is not None:
         myCommand += (' ' + argstring)
     print(myCommand)
-    result = subprocess.run(myCommand, shell=True, stdin=subprocess.PIPE)
+    result = subprocess.run(myCommand, shell=True, stdin=subprocess.PIPE,
+                            cwd=cwd)
     if verbose:
         print('runProgram: ', result.stdout)
     if result.returncode != 0:
@@ -835,55 +1056,8 @@ def fieldAgainstRuler(ruler, field, chipPixel):
     return np.floor(p / 3), p % 3, int(pixel)
 
 
-def getLUTforce(zangle, LUTfile):
-    """
-    zangle should be in degree
-    """
-
-    lut = np.loadtxt(LUTfile)
-    ruler = lut[0, :]
-
-    step = ruler[1] - ruler[0]
-
-    p2 = (ruler >= zangle)
-#    print "FINE",p2, p2.shape
-    if (np.count_nonzero(p2) == 0):  # zangle is too large to be in range
-        p2 = ruler.shape[0] - 1
-        p1 = p2
-        w1 = 1
-        w2 = 0
-    elif (p2[0]):  # zangle is too small to be in range
-        p2 = 0  # this is going to be used as index
-        p1 = 0  # this is going to be used as index
-        w1 = 1
-        w2 = 0
-    else:
-        p1 = p2.argmax() - 1
-        p2 = p2.argmax()
-        w1 = (ruler[p2] - zangle) / step
-        w2 = (zangle - ruler[p1]) / step
-
-    return np.dot(w1, lut[1:, p1]) + np.dot(w2, lut[1:, p2])
-
-def runOPD(argList):
-    OPD_inst = argList[0]
-    OPD_cmd = argList[1]
-    inst = argList[2]
-    eimage = argList[3]
-    OPD_log = argList[4]
-    phosimDir = argList[5]
-    zTrueFile = argList[6]
-    nFieldp4 = argList[7]
-    znwcs = argList[8]
-    obscuration = argList[9]
-    opdx = argList[10]
-    opdy = argList[11]
-    srcFile = argList[12]
-    dstFile = argList[13]
-    nOPDw = argList[14]
-    nthread = argList[15]
-    debugLevel = argList[16]
-    
+def runPhosimOPD(OPD_inst, OPD_cmd, inst, eimage, OPD_log, phosimDir,
+                 nthread, debugLevel):
     if debugLevel >= 3:
         runProgram('head %s' % OPD_inst)
         runProgram('head %s' % OPD_cmd)
@@ -901,34 +1075,23 @@ def runOPD(argList):
     if debugLevel >= 2:
         print('DONE RUNNING PHOSIM FOR OPD: %s' % OPD_inst)
         runProgram('date')
-    if os.path.isfile(zTrueFile):
-        os.remove(zTrueFile)
-    fz = open(zTrueFile, 'ab')
-    for i in range(nFieldp4 * nOPDw):
-        src = srcFile.replace('.fits.gz', '_%d.fits.gz' % i)
-        if nOPDw == 1:
-            dst = dstFile.replace('opd', 'opd%d' % i)
-        else:
-            dst = dstFile.replace('opd', 'opd%d_w%d' % (i%nFieldp4, int(i/nFieldp4)))
-        shutil.move(src, dst)
-        runProgram('gunzip -f %s' % dst)
-        opdFile = dst.replace('.gz', '')
-        IHDU = fits.open(opdFile)
-        opd = IHDU[0].data  # Phosim OPD unit: um
-        IHDU.close()
-        idx = (opd != 0)
-        Z = ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx],
-                                  znwcs, obscuration)
-        np.savetxt(fz, Z.reshape(1, -1), delimiter=' ')
-
-    fz.close()
 
-    if debugLevel >= 3:
-        print(opdx)
-        print(opdy)
-        print(znwcs)
-        print(obscuration)
-    
+
+def collectOPD(srcFile, dstFile, opdx, opdy, znwcs, obscuration, writes):
+    """
+    Reads a PhoSim OPD (.fits.gz) and returns its Zernikes. The unzipped
+    OPD goes to dstFile, and srcFile is removed, in the I/O pool; the
+    future is appended to writes. A srcFile PhoSim is still writing raises
+    (EOFError, ...) before anything is written, see aosOutputWatcher.
+    """
+    data = readFile(srcFile)
+    writes.append(submitIO(writeFile, dstFile, data, srcFile))
+    IHDU = fits.HDUList.fromstring(data)
+    opd = IHDU[0].data  # Phosim OPD unit: um
+    IHDU.close()
+    return fitOPDStack(opd[None], opdx, opdy, znwcs, obscuration)[0]
+
+
 def runWFS1side(argList):
     WFS_inst = argList[0]
     WFS_cmd = argList[1]
@@ -938,9 +1101,10 @@ def runWFS1side(argList):
     phosimDir = argList[5]
     numproc = argList[6]
     debugLevel = argList[7]
-    
-    myargs = '%s -c %s -i %s -p %d -e %d > %s 2>&1' % (
-        WFS_inst, WFS_cmd, inst, numproc, eimage,
+    extraArgs = argList[8]  # e.g. -s sensors -w workdir -o outputdir
+
+    myargs = '%s -c %s -i %s -p %d -e %d %s > %s 2>&1' % (
+        WFS_inst, WFS_cmd, inst, numproc, eimage, extraArgs,
         WFS_log)
     if debugLevel >= 2:
         print('********Runnnig PHOSIM with following parameters\
@@ -953,96 +1117,98 @@ def runWFS1side(argList):
     
 
 def writeM1M3zres(surf, x, y, Ri, R, R3i, R3, n, zlist, resFile1, resFile3,
-                      nodeID, surfaceGridN):
-    
-    zc = ZernikeFit(surf, x / R, y / R, n)
-    res = surf - ZernikeEval(zc, x / R, y / R)
+                      nodeID, surfaceGridN, sidecar=False, proj=None,
+                      jobs=None):
+    """
+    proj is the ZernikeProjector for n terms on (x/R, y/R), e.g. from
+    aosM1M3.getZernikeProjector(); None makes (or reuses) one here.
+    jobs=None makes the surface maps here; otherwise their gridSamp()
+    arguments are appended to jobs, see runGridSampJobs().
+    """
+    ownJobs = jobs is None
+    if ownJobs:
+        jobs = []
+    if proj is None:
+        proj = getZernikeProjector(x / R, y / R, n)
+    zc = proj.fit(surf)
+    res = surf - proj.eval(zc)
     np.savetxt(zlist, zc)
     idx1 = nodeID == 1
     idx3 = nodeID == 3
 
     # so far x and y are in meter, res is in micron
     # zemax wants everything in mm
-    gridSamp(x[idx1] * 1e3, y[idx1] * 1e3, res[idx1] * 1e-3,
+    jobs.append((x[idx1] * 1e3, y[idx1] * 1e3, res[idx1] * 1e-3,
                  Ri * 1e3, R * 1e3, resFile1,
-                 surfaceGridN, surfaceGridN, 1)
-    gridSamp(x[idx3] * 1e3, y[idx3] * 1e3, res[idx3] * 1e-3,
+                 surfaceGridN, surfaceGridN, 1, sidecar))
+    jobs.append((x[idx3] * 1e3, y[idx3] * 1e3, res[idx3] * 1e-3,
                  R3i * 1e3, R3 * 1e3, resFile3,
-                 surfaceGridN, surfaceGridN, 1)
+                 surfaceGridN, surfaceGridN, 1, sidecar))
+    if ownJobs:
+        runGridSampJobs(jobs)
 
     
-def writeM2zres(surf, x, y, R, Ri, n, zlist, resFile2, surfaceGridN):
-    zc = ZernikeFit(surf, x / R, y / R, n)
-    res = surf - ZernikeEval(zc, x / R, y / R)
+def writeM2zres(surf, x, y, R, Ri, n, zlist, resFile2, surfaceGridN,
+                sidecar=False, proj=None, jobs=None):
+    """same as writeM1M3zres(), proj can come from aosM2"""
+    ownJobs = jobs is None
+    if ownJobs:
+        jobs = []
+    if proj is None:
+        proj = getZernikeProjector(x / R, y / R, n)
+    zc = proj.fit(surf)
+    res = surf - proj.eval(zc)
     np.savetxt(zlist, zc)
 
     # so far x and y are in meter, res is in micron
     # zemax wants everything in mm
-    gridSamp(x * 1e3, y * 1e3, res * 1e-3, Ri * 1e3, R * 1e3, resFile2,
-                 surfaceGridN, surfaceGridN, 1)
-    
-def gridSamp(xf, yf, zf, innerR, outerR, resFile, nx, ny, plots):
-    
-    Ff = Rbf(xf, yf, zf)
-    #do not want to cover the edge? change 4->2 on both lines
-    NUM_X_PIXELS = nx + 4  #alway extend 2 points on each side
-    NUM_Y_PIXELS = ny + 4 
-
-    extFx = (NUM_X_PIXELS - 1) / (nx - 1) #this is spatial extension factor
-    extFy = (NUM_Y_PIXELS - 1) / (ny - 1)
-    extFr = np.sqrt(extFx * extFy)
-
-    delx =  outerR*2 *extFx / (NUM_X_PIXELS - 1)
-    dely =  outerR*2 *extFy / (NUM_Y_PIXELS - 1)
-
-    minx = -0.5*(NUM_X_PIXELS-1)*delx
-    miny = -0.5*(NUM_Y_PIXELS-1)*dely
-    epsilon = .0001 * min(delx, dely)
-    zp = np.zeros((NUM_X_PIXELS, NUM_Y_PIXELS))
+    jobs.append((x * 1e3, y * 1e3, res * 1e-3, Ri * 1e3, R * 1e3, resFile2,
+                 surfaceGridN, surfaceGridN, 1, sidecar))
+    if ownJobs:
+        runGridSampJobs(jobs)
+
+
+def runGridSamp(args):
+    """gridSamp(*args), returns the time it took"""
+    t0 = time.time()
+    gridSamp(*args)
+    return time.time() - t0
+
+
+def runGridSampJobs(jobs, pool=None, debugLevel=0):
+    """
+    gridSamp() for each job (a tuple of its arguments), through pool (an
+    aosPool) when given, so the surfaces are done at the same time;
+    returns the time of each, in the order of jobs. Any worker can get any
+    surface: the RBF operators they load share their LU factors, see
+    aosSurfaceMap._operators.
+    """
+    if pool is None:
+        times = [runGridSamp(job) for job in jobs]
+    else:
+        times = pool.map(runGridSamp, jobs, chunksize=1)
+    if debugLevel >= 1:
+        for job, t in zip(jobs, times):
+            print('%s: %.2f s' % (os.path.basename(job[5]), t))
+    return times
+
     
-    outid = open(resFile, 'w');
-    # Write four numbers for the header line
-    outid.write('%d %d %.9E %.9E\n' % (NUM_X_PIXELS, NUM_Y_PIXELS, delx, dely))
-
-    #  Write the rows and columns
-    for j in range(1, NUM_X_PIXELS + 1):
-        for i in range(1, NUM_Y_PIXELS + 1):
-            x =  minx + (i - 1) * delx
-            y =  miny + (j - 1) * dely
-            y = -y  # invert top to bottom, because Zemax reads (-x,-y) first
-        
-            # compute the sag */
-            r = np.sqrt(x*x+y*y)
-
-            if (r<innerR/extFr or r>outerR*extFr):
-                z=0
-                dx=0
-                dy=0
-                dxdy=0
-            else:
-                z=Ff(x,y)
-                tem1=Ff((x+epsilon),y)
-                tem2=Ff((x-epsilon),y)
-                dx = (tem1 - tem2)/(2.0*epsilon)
-                
-                # compute dz/dy */
-                tem1=Ff(x,(y+epsilon))
-                tem2=Ff(x,(y-epsilon))
-                dy = (tem1 - tem2)/(2.0*epsilon)
-                
-                # compute d2z/dxdy */
-                tem1=Ff((x+epsilon),(y+epsilon))
-                tem2=Ff((x-epsilon),(y+epsilon))
-                tem3 = (tem1 - tem2)/(2.0*epsilon)
-                tem1=Ff((x+epsilon),(y-epsilon))
-                tem2=Ff((x-epsilon),(y-epsilon))
-                tem4 = (tem1 - tem2)/(2.0*epsilon)
-                dxdy = (tem3 - tem4)/(2.0*epsilon)
-
-            zp[NUM_X_PIXELS+1-j-1, i-1]=z
-            outid.write('%.9E %.9E %.9E %.9E\n'% (z, dx, dy, dxdy))
-     
-    outid.close()
+def gridSamp(xf, yf, zf, innerR, outerR, resFile, nx, ny, plots,
+             sidecar=False):
+
+    op = getRbfGridOperator(xf, yf, innerR, outerR, nx, ny)
+    NUM_X_PIXELS = op.NUM_X_PIXELS
+    NUM_Y_PIXELS = op.NUM_Y_PIXELS
+    delx = op.delx
+    dely = op.dely
+    minx = op.minx
+    miny = op.miny
+    z, dx, dy, dxdy = op.apply(zf)
+    # flip top to bottom for the plot, same as the Zemax grid
+    zp = z.reshape((NUM_X_PIXELS, NUM_Y_PIXELS))[::-1, :]
+
+    writeSurfaceMap(resFile, z, dx, dy, dxdy, NUM_X_PIXELS, NUM_Y_PIXELS,
+                    delx, dely, sidecar=sidecar)
 
     if plots:
         fig, ax = plt.subplots(1, 2, figsize=(10, 5))
@@ -4,9 +4,10 @@
 # @       Large Synoptic Survey Telescope
 
 import os
-import multiprocessing
 import re
 import aosTeleState
+from aosPool import aosPool, getShared
+from aosDataBundle import loadData
 
 import numpy as np
 from astropy.io import fits
@@ -53,11 +54,11 @@ class aosWFS(object):
         if np.abs(wavelength - 0.5)>1e-3:
             intrinsicFile = intrinsicFile.replace(
                 'zn.txt', 'zn_%s.txt' % band.upper())
-        intrinsicAll = np.loadtxt(intrinsicFile)
+        intrinsicAll = loadData(intrinsicFile)
         intrinsicAll = intrinsicAll * wavelength
         self.intrinsicWFS = intrinsicAll[
             -self.nWFS:, 3:self.algo.numTerms].reshape((-1, 1))
-        self.covM = np.loadtxt('%s/../data/covM86.txt'% aosSrcDir)  # in unit of nm^2
+        self.covM = loadData('%s/../data/covM86.txt'% aosSrcDir)  # in unit of nm^2
         self.covM = self.covM * 1e-6  # in unit of um^2
 
         if debugLevel >= 3:
@@ -162,18 +163,19 @@ class aosWFS(object):
             intraImage = Image(intraCrop, (extraFieldX, extraFieldY), 'intra')
             extraImage = Image(extraCrop, (intraFieldX, intraFieldY), 'extra')
 
-            argList.append((self.algo, chip, intraSourceId, extraSourceId, intraImage, extraImage,
-                            self.inst,
+            argList.append((chip, intraSourceId, extraSourceId, intraImage, extraImage,
                             cwfsModel))
         return argList
 
-    def processPairs(self, pairs, candidates, cwfsModel, numProc):
+    def processPairs(self, pairs, candidates, cwfsModel, numProc, pool=None):
         # This argList is necessary for multiprocessing.
+        # The pool needs the cwfs algorithm and instrument, see getPoolConstants().
         argList = self.prepareArgList(pairs, candidates, cwfsModel)
-        pool = multiprocessing.Pool(numProc)
-        parallelOutput = pool.map(aosWFS.runcwfs, argList)
-        pool.close()
-        pool.join()
+        if pool is None:
+            with aosPool(numProc, constants=self.getPoolConstants()) as pool:
+                parallelOutput = pool.map(aosWFS.runcwfs, argList)
+        else:
+            parallelOutput = pool.map(aosWFS.runcwfs, argList)
 
         # Consolidate parallel output into a table.
         zernikes = Table(names=['chip', 'intraSourceId', 'extraSourceId', 'caustic'] + aosWFS.ZS,
@@ -194,13 +196,16 @@ class aosWFS(object):
         masterZernikes = join(aggZernikes, caustics, keys=['chip'], join_type='inner')
         return masterZernikes
 
-    def parallelCwfs(self, catalog, cwfsModel, numproc, debugLevel):
+    def getPoolConstants(self):
+        return {'cwfsAlgo': self.algo, 'cwfsInst': self.inst}
+
+    def parallelCwfs(self, catalog, cwfsModel, numproc, debugLevel, pool=None):
         candidates = self.findCandidates(catalog)
         self.writeTable(candidates, 'candidates.csv')
         pairs = self.selectPairs(candidates)
         self.writeTable(pairs, 'pairs.csv')
         self.plotPairing(candidates, pairs, 'pairing.png')
-        argList, zernikes = self.processPairs(pairs, candidates, cwfsModel, numproc)
+        argList, zernikes = self.processPairs(pairs, candidates, cwfsModel, numproc, pool)
         self.plotDonutsAndZernikes(argList, zernikes, 'donutsAndZernikes.png')
         self.writeTable(zernikes, 'zernikes.csv')
         masterZernikes = self.makeMasterZernikes(candidates, zernikes)
@@ -320,7 +325,7 @@ class aosWFS(object):
         zAll = aosWFS.rowToZernikes(zernikes[self.ZS].groups.aggregate(np.mean))
 
         for i,args in enumerate(argList):
-            _, chip, intraSourceId, extraSourceId, intraImage, extraImage, _, _  = args
+            chip, intraSourceId, extraSourceId, intraImage, extraImage, _ = args
             plt.subplot(nPairs,3,i*3+1)
             plt.title('{}, {}, Intra'.format(chip, intraSourceId), fontsize=8)
             cb = plt.imshow(intraImage.image, origin='lower', cmap='hot')
@@ -355,7 +360,9 @@ class aosWFS(object):
 
     @staticmethod
     def runcwfs(args):
-        algo, chip, intraSourceId, extraSourceId, intraImage, extraImage, inst, model = args
+        chip, intraSourceId, extraSourceId, intraImage, extraImage, model = args
+        algo = getShared('cwfsAlgo')
+        inst = getShared('cwfsInst')
         algo.reset(intraImage, extraImage)
         algo.runIt(inst, intraImage, extraImage, model)
         return chip, intraSourceId, extraSourceId, algo.caustic, algo.zer4UpNm * 1e-3
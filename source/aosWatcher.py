@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+import glob
+import time
+import zlib
+import threading
+
+# what reading a .gz that is still being written raises
+incompleteErrors = (EOFError, zlib.error, OSError)
+
+
+class aosOutputWatcher(object):
+    """
+    Watches for PhoSim output files while PhoSim is still running, and
+    hands each one to callback(path), in a thread of its own, once it looks
+    complete. A .gz file is tried once its size did not change over one
+    poll; if callback fails to unzip it (EOFError, zlib.error, OSError such
+    as gzip.BadGzipFile), it is still being written and is tried again at
+    the next poll. Other files can't be checked that way, so they wait for
+    their size and mtime to stay the same over two polls, and for the mtime
+    to be at least one interval old. Call finish() when PhoSim is done; it
+    takes what is left, and raises what callback raised.
+    """
+
+    def __init__(self, patterns, callback, interval=1.0):
+        """
+        patterns: glob patterns of the files to watch for
+        interval: seconds between polls
+        """
+        self.patterns = patterns
+        self.callback = callback
+        self.interval = interval
+        self.stats = {}
+        self.claimed = []
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def poll(self, final=False):
+        for pattern in self.patterns:
+            for path in sorted(glob.glob(pattern)):
+                if path in self.claimed:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stat = (st.st_size, st.st_mtime_ns)
+                last, nStable = self.stats.get(path, (None, 0))
+                nStable = nStable + 1 if stat == last else 0
+                self.stats[path] = (stat, nStable)
+                if not final:
+                    if st.st_size == 0 or nStable < 1:
+                        continue
+                    if not path.endswith('.gz') and (
+                            nStable < 2 or
+                            time.time() - st.st_mtime < self.interval):
+                        continue
+                try:
+                    self.callback(path)
+                except incompleteErrors:
+                    if final or not path.endswith('.gz'):
+                        raise
+                    continue
+                self.claimed.append(path)
+
+    def run(self):
+        try:
+            while not self.done.wait(self.interval):
+                self.poll()
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """
+        the files are all written; returns the claimed files, in order
+        """
+        self.done.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.poll(final=True)
+        return self.claimed
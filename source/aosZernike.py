@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+##
+# @authors: Bo Xin
+# @       Large Synoptic Survey Telescope
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from lsst.cwfs.tools import ZernikeAnnularEval
+from lsst.cwfs.tools import ZernikeEval
+
+from aosCache import arrayKey
+
+# projectors built in this process, least recently used first. Each
+# process, aosPool workers too, keeps up to maxProjectorBytes of them
+# (AOS_PROJECTOR_MB, default 512). On a 255x255 pupil one costs about
+# 1 MB per Zernike term: 23 MB for the 22 term OPD fits, 3 MB for
+# removePTT(); all 35 OPD fields of lsst need about 800 MB.
+_projectors = OrderedDict()
+_projectorBytes = 0
+maxProjectorBytes = int(os.environ.get('AOS_PROJECTOR_MB', 512)) * 2**20
+
+
+class ZernikeProjector(object):
+    """
+    Zernike basis and its pseudo-inverse on a fixed set of points, so that
+    fitting is one matrix product instead of a new least-squares problem.
+    e=None gives the circular Zernikes of ZernikeFit/ZernikeEval,
+    otherwise the annular Zernikes of ZernikeAnnularFit/ZernikeAnnularEval
+    with obscuration e.
+    """
+
+    def __init__(self, x, y, numTerms, e=None):
+        self.numTerms = numTerms
+        self.e = e
+        x = np.asarray(x, dtype=np.float64).flatten()
+        y = np.asarray(y, dtype=np.float64).flatten()
+        self.H = np.zeros((x.shape[0], numTerms))
+        for i in range(numTerms):
+            Z = np.zeros(numTerms)
+            Z[i] = 1
+            if e is None:
+                self.H[:, i] = ZernikeEval(Z, x, y)
+            else:
+                self.H[:, i] = ZernikeAnnularEval(Z, x, y, e)
+        self.Hinv = np.linalg.pinv(self.H)
+        self.nbytes = self.H.nbytes + self.Hinv.nbytes
+
+    def fit(self, s):
+        """
+        s is (nPoint,) or a stack (nPoint, nSurf);
+        returns the coefficients, (numTerms,) or (numTerms, nSurf).
+        """
+        return self.Hinv.dot(s)
+
+    def eval(self, Z):
+        return self.H.dot(Z)
+
+    def residual(self, s):
+        """s with its best fit over the numTerms Zernikes removed"""
+        return s - self.H.dot(self.Hinv.dot(s))
+
+
+def getZernikeProjector(x, y, numTerms, e=None, mask=None):
+    """
+    Cached ZernikeProjector on the points x[mask], y[mask].
+    Projectors are keyed by grid, mask, numTerms and e, and the least
+    recently used ones are dropped beyond maxProjectorBytes.
+    """
+    global _projectorBytes
+    key = (np.shape(x), numTerms, e, arrayKey(
+        np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+        mask))
+
+    if key in _projectors:
+        _projectors.move_to_end(key)
+        return _projectors[key]
+
+    if mask is None:
+        proj = ZernikeProjector(x, y, numTerms, e)
+    else:
+        proj = ZernikeProjector(x[mask], y[mask], numTerms, e)
+    _projectors[key] = proj
+    _projectorBytes += proj.nbytes
+    while _projectorBytes > maxProjectorBytes and len(_projectors) > 1:
+        _projectorBytes -= _projectors.popitem(last=False)[1].nbytes
+    return proj
+
+
+def fitOPD(opd, opdx, opdy, numTerms, e):
+    """
+    Same as ZernikeAnnularFit(opd[idx], opdx[idx], opdy[idx], numTerms, e)
+    with idx = (opd != 0).
+    """
+    idx = (opd != 0)
+    proj = getZernikeProjector(opdx, opdy, numTerms, e, mask=idx)
+    return proj.fit(opd[idx])
+
+
+def fitOPDStack(opds, opdx, opdy, numTerms, e):
+    """
+    fitOPD() on a (nOPD, m, m) stack. OPDs that share a pupil are fitted
+    together with one matrix product. Returns (nOPD, numTerms).
+    """
+    Z = np.zeros((opds.shape[0], numTerms))
+    idx = (opds != 0)
+    masks = {}
+    for i in range(opds.shape[0]):
+        masks.setdefault(np.packbits(idx[i]).tobytes(), []).append(i)
+    for group in masks.values():
+        mask = idx[group[0]]
+        proj = getZernikeProjector(opdx, opdy, numTerms, e, mask=mask)
+        Z[group, :] = proj.fit(opds[group][:, mask].T).T
+    return Z
+
+
+def removePTT(opd, opdx, opdy):
+    """
+    Remove piston, tip and tilt from opd in place; outside of the pupil
+    (opd == 0) everything stays zero.
+    """
+    idx = (opd != 0)
+    proj = getZernikeProjector(opdx, opdy, 3, 0, mask=idx)
+    opd[idx] = proj.residual(opd[idx])
+    return opd
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# @author: Bo Xin
+# @      Large Synoptic Survey Telescope
+
+# ellipticity from OPD maps, with the FFTs padded the usual way and padded
+# to fast sizes (aosMetric fastFFT): timing and agreement.
+# PSSN is not affected, its FFTs are not padded.
+
+import argparse
+import time
+import numpy as np
+
+from lsst.cwfs.tools import ZernikeAnnularEval
+
+from aosZernike import removePTT
+from aosFFT import padSize
+from aosMetric import psf2eAtmWStack
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='-----FFT padding benchmark------')
+    parser.add_argument('-n', dest='nOPD', default=31, type=int,
+                        help='number of OPD maps, default=31')
+    parser.add_argument('-m', dest='opdSize', default=255, type=int,
+                        help='OPD size in pixel, default=255')
+    parser.add_argument('-w', dest='wlum', default=0.5, type=float,
+                        help='wavelength in micron, default=0.5')
+    parser.add_argument('-rms', dest='rms', default=0.1, type=float,
+                        help='rms of each of z4-z22 in micron, default=0.1')
+    parser.add_argument('-p', dest='numproc', default=1, type=int,
+                        help='Number of FFT threads')
+    parser.add_argument('-seed', dest='seed', default=0, type=int,
+                        help='random seed, default=0')
+    args = parser.parse_args()
+
+    obscuration = 0.61
+    aa = np.linspace(-1, 1, args.opdSize)
+    opdx, opdy = np.meshgrid(aa, aa)
+    r = np.sqrt(opdx**2 + opdy**2)
+    idx = (r <= 1) & (r >= obscuration)
+
+    np.random.seed(args.seed)
+    opd = np.zeros((args.nOPD, args.opdSize, args.opdSize))
+    for i in range(args.nOPD):
+        Z = np.zeros(22)
+        Z[3:] = np.random.normal(0, args.rms, 19)
+        opd[i][idx] = ZernikeAnnularEval(Z, opdx[idx], opdy[idx], obscuration)
+        removePTT(opd[i], opdx, opdy)
+
+    k = 1.2335 * args.wlum / 0.2
+    print('opdSize = %d, %d OPDs at %4.2f um' % (
+        args.opdSize, args.nOPD, args.wlum))
+    N = padSize(args.opdSize, k)
+    Nfast = padSize(args.opdSize, k, True)
+
+    t0 = time.time()
+    elli = psf2eAtmWStack(opd, args.wlum, workers=args.numproc)
+    t1 = time.time()
+    ellif = psf2eAtmWStack(opd, args.wlum, fast=True, workers=args.numproc)
+    t2 = time.time()
+
+    print('FFT size  %5d  %5d' % (N, Nfast))
+    print('time (s)  %5.2f  %5.2f' % (t1 - t0, t2 - t1))
+    print('mean elli = %6.4f, max |elli diff| = %8.2e' % (
+        np.mean(elli), np.max(np.abs(ellif - elli))))
+
+if __name__ == "__main__":
+    main()
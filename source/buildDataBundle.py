@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+# @author: Bo Xin
+# @      Large Synoptic Survey Telescope
+
+# pack the model data in data/ into one memory-mapped bundle (aosDataBundle).
+# Rebuild it after changing anything in data/; -check tells if it is stale.
+
+import argparse
+
+from aosDataBundle import getBundleFile, buildBundle, dataVersion
+from aosDataBundle import aosDataBundle
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='-----build the AOS data bundle------')
+    parser.add_argument('-o', dest='bundleFile', default=getBundleFile(),
+                        help='output file, default=$AOS_DATA_BUNDLE, \
+                        or data/aos.bundle')
+    parser.add_argument('-check', action='store_true',
+                        help='only check that the bundle matches data/')
+    args = parser.parse_args()
+
+    if args.check:
+        bundle = aosDataBundle(args.bundleFile)
+        version = dataVersion()
+        if bundle.version == version:
+            print('%s is up to date (%s)' % (args.bundleFile, version))
+        else:
+            print('%s is stale: %s, data/ is %s' % (
+                args.bundleFile, bundle.version, version))
+        return
+
+    version = buildBundle(args.bundleFile)
+    bundle = aosDataBundle(args.bundleFile)
+    print('%s: %d arrays, version %s' % (
+        args.bundleFile, len(bundle.index), version))
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,9 @@ class Catalog(object):
             self.table = Table(names=('sourceId', 'ra', 'dec', 'mag', 'sed'),
                            dtype=('i8', 'f16', 'f16', 'f8', 'S'))
 
-    def addSource(self, ra, dec, mag, sed):
-        self.table.add_row((self.__sourceIdCounter, ra, dec, mag, sed))
+    def addSource(self, ra, dec, mag, sed, *extra):
+        # extra: values of any further columns, e.g. chip in GridCatalog
+        self.table.add_row((self.__sourceIdCounter, ra, dec, mag, sed) + extra)
         self.__sourceIdCounter += 1
 
     def toFile(self, fname):
@@ -26,9 +27,24 @@ class Catalog(object):
         template = 'object {} {} {} {} ../sky/{} ' \
                '0.0 0.0 0.0 0.0 0.0 0.0 star 0.0 none none\n'
         lines = [template.format(sourceId, ra, dec, mag, sed) for sourceId, ra, dec, mag, sed in
-             self.table]
+             zip(*[self.table[c] for c in ('sourceId', 'ra', 'dec', 'mag', 'sed')])]
         return ''.join(lines)
 
+    def byChip(self):
+        """
+        {chip: Catalog of the sources on it}, in the order the chips first
+        appear. Needs a chip column, as in GridCatalog; without one it is
+        {None: self}.
+        """
+        if 'chip' not in self.table.colnames:
+            return {None: self}
+        chips = []
+        for chip in self.table['chip']:
+            if chip not in chips:
+                chips.append(chip)
+        return {chip: Catalog(table=self.table[self.table['chip'] == chip])
+                for chip in chips}
+
     @classmethod
     def fromFile(cls, fname):
         table = Table.read(fname, format='csv')
@@ -39,10 +55,13 @@ class GridCatalog(Catalog):
     """
     Used to make a grid of nxn sources on each listed chip.
     Assumes boresight is (0,0) and rotation is 0.
+    The chip of each source is in the chip column.
     """
     def __init__(self, n=5, chips=['R00_S22', 'R04_S20', 'R40_S02', 'R44_S00'], mag=17,
                  sed='../sky/sed_500.txt'):
-        super().__init__()
+        super().__init__(table=Table(
+            names=('sourceId', 'ra', 'dec', 'mag', 'sed', 'chip'),
+            dtype=('i8', 'f16', 'f16', 'f8', 'S', 'U7')))
 
         # lazy imports
         from lsst.obs.lsst.phosim import PhosimMapper
@@ -61,4 +80,4 @@ class GridCatalog(Catalog):
 
             for ra in np.linspace(min(ras), max(ras), n + 2)[1:-1]:
                 for dec in np.linspace(min(decs), max(decs), n + 2)[1:-1]:
-                    self.addSource(ra, dec, mag, sed)
+                    self.addSource(ra, dec, mag, sed, chip)
@@ -9,6 +9,8 @@ import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 
+from aosDataBundle import loadData
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -19,13 +21,13 @@ def main():
 
     if args.mirror == 'M1M3':
         # bending modes
-        aa = np.loadtxt('data/M1M3/M1M3_1um_156_grid.DAT')
+        aa = loadData('data/M1M3/M1M3_1um_156_grid.DAT')
         # nodeID = aa[:, 0]
         bx = aa[:, 1]
         by = aa[:, 2]
         bz = aa[:, 3:]
     elif args.mirror == 'M2':
-        aa = np.loadtxt('data/M2/M2_1um_grid.DAT')
+        aa = loadData('data/M2/M2_1um_grid.DAT')
         bx = aa[:, 0]
         by = aa[:, 1]
         bz = aa[:, 2:]
@@ -12,6 +12,7 @@ import datetime
 import os
 import sys
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 
 from aosWFS import aosWFS
@@ -21,6 +22,8 @@ from aosMetric import aosMetric
 from aosM1M3 import aosM1M3
 from aosM2 import aosM2
 from aosTeleState import aosTeleState
+from aosPool import aosPool
+from aosIO import setIOThreads
 from catalog import Catalog, GridCatalog
 
 
@@ -58,6 +61,28 @@ regenrating pert files',
                         action='store_true')
     parser.add_argument('-ellioff', help='w/o calculating ellipticity',
                         action='store_true')
+    parser.add_argument('-pssnmode', dest='pssnmode', default='fft',
+                        choices=('fft', 'zernike', 'both'),
+                        help='fft: PSSN from the OPD maps; \
+                        zernike: PSSN and FWHM from the OPD Zernikes, \
+                        with quadratic models; \
+                        both: fft (with -fwhm), and report how far zernike \
+                        is from it, default=fft')
+    parser.add_argument('-fwhm', help='also calculate FWHM with \
+psf2FWHMring()',
+                        action='store_true')
+    parser.add_argument('-fastfft', help='pad ellipticity FFTs to fast \
+sizes, ellipticity changes by ~1e-5',
+                        action='store_true')
+    parser.add_argument('-overlap', help='with -s phosim, run the OPD and \
+WFS PhoSim jobs at the same time, with half of -p each',
+                        action='store_true')
+    parser.add_argument('-opdshards', dest='opdShards', default=1, type=int,
+                        help='split the OPD PhoSim run into this many \
+                        concurrent runs (at most 9), default=1')
+    parser.add_argument('-iothreads', dest='ioThreads', default=None,
+                        type=int, help='number of files written at once, \
+                        default=$AOS_IO_THREADS, or 4')
     parser.add_argument('-makesum', help='make summary plot,\
 assuming all data available',
                         action='store_true')
@@ -160,7 +185,8 @@ assuming all data available',
     # *****************************************
     # control algorithm
     # *****************************************
-    metr = aosMetric(args.inst, state.opdSize, wfs.znwcs3, args.debugLevel)
+    metr = aosMetric(args.inst, state.opdSize, wfs.znwcs3, args.debugLevel,
+                     fastFFT=args.fastfft)
     ctrl = aosController(args.inst, args.controllerParam, esti, metr, wfs,
                          M1M3, M2,
                          effwave, args.gain, args.debugLevel)
@@ -181,63 +207,112 @@ assuming all data available',
     #         catalog.addSource(x, y + d, mag, sed)
     #         catalog.addSource(x, y - d, mag, sed)
 
-    # *****************************************
-    # start the Loop
-    # *****************************************
-    for iIter in range(args.startiter, args.enditer + 1):
-        if args.debugLevel >= 3:
-            print('iteration No. %d' % iIter)
+    if args.ioThreads is not None:
+        setIOThreads(args.ioThreads)
+    # worker processes for the whole run, they get the OPD grids and the
+    # cwfs algorithm once
+    pool = aosPool(args.numproc, arrays={'opdx': state.opdx,
+                                         'opdy': state.opdy},
+                   constants=wfs.getPoolConstants())
+    # for the WFS PhoSim run with -overlap
+    executor = ThreadPoolExecutor(1)
 
-        state.setIterNo(metr, iIter, wfs=wfs)
-        wfs.setIterNo(iIter)
+    # if an iteration fails, still wait for the WFS PhoSim job of
+    # -overlap, and free the workers and their shared memory
+    try:
+        # *****************************************
+        # start the Loop
+        # *****************************************
+        for iIter in range(args.startiter, args.enditer + 1):
+            if args.debugLevel >= 3:
+                print('iteration No. %d' % iIter)
 
-        if not args.ctrloff:
-            if iIter > 0:  # args.startiter:
-                esti.estimate(state, wfs, ctrl, args.sensor)
-                ctrl.getMotions(esti, metr, wfs, state)
-                ctrl.drawControlPanel(esti, state)
+            state.setIterNo(metr, iIter, wfs=wfs)
+            wfs.setIterNo(iIter)
 
-                # need to remake the pert file here.
-                # It will be inserted into OPD.inst, PSF.inst later
-                state.update(esti, ctrl, M1M3, M2)
-            if args.baserun > 0 and iIter == 0:
-                state.getPertFilefromBase(args.baserun)
-            else:
-                state.writePertFile(esti.ndofA, M1M3=M1M3, M2=M2)
+            if not args.ctrloff:
+                if iIter > 0:  # args.startiter:
+                    esti.estimate(state, wfs, ctrl, args.sensor)
+                    ctrl.getMotions(esti, metr, wfs, state)
+                    ctrl.drawControlPanel(esti, state)
 
-        if args.baserun > 0 and iIter == 0:
-            state.getOPDAllfromBase(args.baserun, metr)
-            metr.getPSSNandMorefromBase(args.baserun, state)
-            metr.getEllipticityfromBase(args.baserun, state)
-            if (args.sensor == 'ideal' or args.sensor == 'covM' or
-                    args.sensor == 'pass' or args.sensor == 'check'):
-                pass
-            else:
-                wfs.getZ4CfromBase(args.baserun, state)
-        else:
-            state.getOPDAll(args.opdoff, metr, args.numproc,
-                            wfs.znwcs, wfs.inst.obscuration, args.debugLevel)
+                    # need to remake the pert file here.
+                    # It will be inserted into OPD.inst, PSF.inst later
+                    state.update(esti, ctrl, M1M3, M2)
+                if args.baserun > 0 and iIter == 0:
+                    state.getPertFilefromBase(args.baserun)
+                else:
+                    state.writePertFile(esti.ndofA, M1M3=M1M3, M2=M2, pool=pool,
+                                        debugLevel=args.debugLevel)
 
-            metr.getPSSNandMore(args.pssnoff, state,
-                                args.numproc, args.debugLevel)
+            if args.baserun > 0 and iIter == 0:
+                state.getOPDAllfromBase(args.baserun, metr)
+                metr.getPSSNandMorefromBase(args.baserun, state)
+                metr.getEllipticityfromBase(args.baserun, state)
+                if (args.sensor == 'ideal' or args.sensor == 'covM' or
+                        args.sensor == 'pass' or args.sensor == 'check'):
+                    pass
+                else:
+                    wfs.getZ4CfromBase(args.baserun, state)
+            else:
+                # the WFS PhoSim run only needs the pert file, so with -overlap
+                # it goes next to the OPD one, and we join it before cwfs
+                wfsJob = None
+                opdProc = args.numproc
+                if args.overlap and args.sensor == 'phosim':
+                    wfsProc = args.numproc
+                    if not args.opdoff:
+                        opdProc = max(1, args.numproc // 2)
+                        wfsProc = max(1, args.numproc - opdProc)
+                    wfsJob = executor.submit(state.getWFSAll, wfs, catalog,
+                                             wfsProc, args.debugLevel)
+                state.getOPDAll(args.opdoff, metr, opdProc,
+                                wfs.znwcs, wfs.inst.obscuration, args.debugLevel,
+                                args.opdShards)
 
-            metr.getEllipticity(args.ellioff, state,
-                                args.numproc, args.debugLevel)
+                if args.pssnmode == 'fft':
+                    metr.getOPDMetrics(args.pssnoff, args.ellioff, state,
+                                       args.numproc, args.debugLevel,
+                                       fwhm=args.fwhm)
+                elif args.pssnmode == 'zernike':
+                    if not args.pssnoff:
+                        metr.getPSSNfromZ(state, args.debugLevel)
+                        metr.getFWHMfromZ(state, args.debugLevel)
+                    metr.getOPDMetrics(True, args.ellioff, state,
+                                       args.numproc, args.debugLevel)
+                else:
+                    if not args.pssnoff:
+                        metr.getPSSNfromZ(state, args.debugLevel,
+                                          outFile=metr.zPSSNFile)
+                        metr.getFWHMfromZ(state, args.debugLevel)
+                    # the FFT FWHM too, to check the FWHM model against
+                    metr.getOPDMetrics(args.pssnoff, args.ellioff, state,
+                                       args.numproc, args.debugLevel,
+                                       fwhm=True)
+                    if not args.pssnoff:
+                        metr.comparePSSN(metr.zPSSNFile, metr.PSSNFile,
+                                         metr.zFWHMFile, metr.FWHMFile)
 
-            if (args.sensor == 'ideal' or args.sensor == 'covM' or
-                    args.sensor == 'pass'):
-                pass
-            else:
-                if args.sensor == 'phosim':
-                    # create donuts for last iter,
-                    # so that picking up from there will be easy
-                    state.getWFSAll(wfs, catalog, args.numproc, args.debugLevel)
-                    state.makeAtmosphereFile(metr, wfs, args.debugLevel)
-                if args.sensor == 'phosim' or args.sensor == 'cwfs':
-                    wfs.parallelCwfs(catalog, cwfsModel, args.numproc, args.debugLevel)
-                if args.sensor == 'phosim' or args.sensor == 'cwfs' \
-                        or args.sensor == 'check':
-                    wfs.checkZ4C(state, metr, args.debugLevel)
+                if (args.sensor == 'ideal' or args.sensor == 'covM' or
+                        args.sensor == 'pass'):
+                    pass
+                else:
+                    if args.sensor == 'phosim':
+                        # create donuts for last iter,
+                        # so that picking up from there will be easy
+                        if wfsJob is None:
+                            state.getWFSAll(wfs, catalog, args.numproc, args.debugLevel)
+                        else:
+                            wfsJob.result()
+                        state.makeAtmosphereFile(metr, wfs, args.debugLevel)
+                    if args.sensor == 'phosim' or args.sensor == 'cwfs':
+                        wfs.parallelCwfs(catalog, cwfsModel, args.numproc, args.debugLevel, pool)
+                    if args.sensor == 'phosim' or args.sensor == 'cwfs' \
+                            or args.sensor == 'check':
+                        wfs.checkZ4C(state, metr, args.debugLevel)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        pool.close()
 
     ctrl.drawSummaryPlots(state, metr, esti, M1M3, M2,
                           args.startiter, args.enditer, args.debugLevel)
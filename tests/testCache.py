@@ -0,0 +1,102 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+import aosCache
+from aosCache import loadtxtCached, ArtifactCache
+
+
+class TestLoadtxtCached(unittest.TestCase):
+    """Test the binary copies made by loadtxtCached."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.txtFile = os.path.join(self.dir, 'data.txt')
+        np.savetxt(self.txtFile, np.arange(12.).reshape(4, 3),
+                   header='x y z')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRoundTrip(self):
+        a = loadtxtCached(self.txtFile, skiprows=1)
+        self.assertTrue(os.path.isfile(self.txtFile + '.npz'))
+        np.testing.assert_array_equal(a, np.loadtxt(self.txtFile))
+        np.testing.assert_array_equal(
+            loadtxtCached(self.txtFile, skiprows=1), a)
+
+    def testRebuild(self):
+        loadtxtCached(self.txtFile, skiprows=1)
+        # a different kwargs or a changed text file don't use the old copy
+        self.assertEqual(loadtxtCached(self.txtFile, skiprows=2).shape,
+                         (3, 3))
+        np.savetxt(self.txtFile, np.ones((2, 3)))
+        np.testing.assert_array_equal(loadtxtCached(self.txtFile),
+                                      np.ones((2, 3)))
+
+
+class TestArtifactCache(unittest.TestCase):
+    """Test storing, linking and evicting with ArtifactCache."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ArtifactCache(os.path.join(self.dir, 'cache'),
+                                   maxBytes=100)
+        self.files = {'a': os.path.join(self.dir, 'a.txt'),
+                      'b': os.path.join(self.dir, 'b.txt')}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, key, text):
+        if not self.cache.get(key, self.files):
+            for name, path in self.files.items():
+                with open(path, 'w') as fid:
+                    fid.write(name + text)
+            self.cache.put(key, self.files)
+
+    def testGetPut(self):
+        self.assertFalse(self.cache.get('k1', self.files))
+        self.write('k1', '1' * 20)
+        os.remove(self.files['a'])
+        self.assertTrue(self.cache.get('k1', self.files))
+        with open(self.files['a']) as fid:
+            self.assertEqual(fid.read(), 'a' + '1' * 20)
+        # a miss removes the links, so rewriting them leaves k1 alone
+        self.write('k2', '2')
+        self.assertTrue(self.cache.get('k1', self.files))
+        with open(self.files['b']) as fid:
+            self.assertEqual(fid.read(), 'b' + '1' * 20)
+
+    def testEvict(self):
+        self.write('k1', '1' * 40)
+        self.write('k2', '2' * 40)
+        # k1 and k2 don't both fit in 100 bytes; k1 is older
+        self.assertFalse(self.cache.get('k1', self.files))
+        self.assertTrue(self.cache.get('k2', self.files))
+
+    def testEvictedMeanwhile(self):
+        self.write('k1', '1')
+        # another process evicts b after get() has seen it
+        entryDir = os.path.join(self.cache.storeDir, 'k1')
+        linkOrCopy = aosCache.linkOrCopy
+
+        def evictThenLink(src, dest):
+            shutil.rmtree(entryDir, ignore_errors=True)
+            linkOrCopy(src, dest)
+        aosCache.linkOrCopy = evictThenLink
+        try:
+            self.assertFalse(self.cache.get('k1', self.files))
+        finally:
+            aosCache.linkOrCopy = linkOrCopy
+        self.assertFalse(any(os.path.lexists(f)
+                             for f in self.files.values()))
+
+    def testArrays(self):
+        cache = ArtifactCache(os.path.join(self.dir, 'cache'))
+        self.assertIsNone(cache.getArrays('k1'))
+        cache.putArrays('k1', pssa=np.float64(0.5))
+        self.assertEqual(float(cache.getArrays('k1')['pssa']), 0.5)
+        self.assertIsNone(ArtifactCache('').getArrays('k1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
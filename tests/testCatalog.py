@@ -1,4 +1,5 @@
 import unittest, os
+from astropy.table import Table
 from catalog import Catalog
 
 
@@ -24,6 +25,22 @@ class TestCatalog(unittest.TestCase):
 
         self.assertEquals(cat1.table['ra'], cat2.table['ra'])
 
+    def testByChip(self):
+        cat = Catalog(table=Table(
+            names=('sourceId', 'ra', 'dec', 'mag', 'sed', 'chip'),
+            dtype=('i8', 'f16', 'f16', 'f8', 'S', 'U7')))
+        cat.addSource(0, 0, 20, 'sed.txt', 'R44_S00')
+        cat.addSource(1, 0, 20, 'sed.txt', 'R00_S22')
+        cat.addSource(2, 0, 20, 'sed.txt', 'R44_S00')
+
+        chips = cat.byChip()
+        self.assertEqual(list(chips), ['R44_S00', 'R00_S22'])
+        self.assertTrue((chips['R44_S00'].table['ra'] == [0, 2]).all())
+        self.assertEqual(chips['R00_S22'].getPhosimBody().split()[:2],
+                         ['object', '1'])
+        cat = Catalog()
+        self.assertIs(cat.byChip()[None], cat)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
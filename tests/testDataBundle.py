@@ -0,0 +1,53 @@
+import unittest, os, shutil, tempfile, warnings
+import numpy as np
+from aosDataBundle import aosDataBundle, buildBundle, dataVersion
+
+
+class TestDataBundle(unittest.TestCase):
+    """Test building and reading a data bundle."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'camera'))
+        os.makedirs(os.path.join(self.dir, 'M1M3'))
+        self.covM = np.arange(9.).reshape(3, 3)
+        np.savetxt(os.path.join(self.dir, 'covM86.txt'), self.covM)
+        self.cam = np.ones((4, 5))
+        np.savetxt(os.path.join(self.dir, 'camera', 'L1RB.txt'), self.cam,
+                   header='header')
+        self.tbdz = np.arange(7, dtype=np.float32)
+        np.save(os.path.join(self.dir, 'M1M3', 'tbdz.npy'), self.tbdz)
+        self.bundleFile = os.path.join(self.dir, 'aos.bundle')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testBundle(self):
+        version = buildBundle(self.bundleFile, self.dir)
+        bundle = aosDataBundle(self.bundleFile, self.dir)
+        self.assertEqual(bundle.version, version)
+        self.assertEqual(len(bundle.index), 3)
+        np.testing.assert_array_equal(bundle.get('covM86.txt'), self.covM)
+        np.testing.assert_array_equal(
+            bundle.get('camera/L1RB.txt', skiprows=1), self.cam)
+        a = bundle.get('M1M3/tbdz.npy')
+        self.assertEqual(a.dtype, self.tbdz.dtype)
+        np.testing.assert_array_equal(a, self.tbdz)
+        self.assertFalse(a.flags.writeable)
+        # read with other kwargs, or not in the bundle
+        self.assertIsNone(bundle.get('camera/L1RB.txt'))
+        self.assertIsNone(bundle.get('pssn_alpha.txt'))
+
+        np.savetxt(os.path.join(self.dir, 'covM86.txt'), self.covM * 2)
+        self.assertNotEqual(dataVersion(self.dir), version)
+        # a changed file is not read from the bundle any more
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.assertIsNone(bundle.get('covM86.txt'))
+            self.assertIsNone(bundle.get('covM86.txt'))
+        self.assertEqual(len(w), 1)
+        self.assertIsNotNone(bundle.get('M1M3/tbdz.npy'))
+
+
+if __name__ == '__main__':
+    unittest.main()
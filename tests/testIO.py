@@ -0,0 +1,35 @@
+import unittest, os, gzip, shutil, tempfile
+from aosIO import collectFile, readFile, submitIO
+
+
+class TestIO(unittest.TestCase):
+    """Test unzipping and moving files with aosIO."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dstDir = os.path.join(self.dir, 'iter0')
+        os.makedirs(self.dstDir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testCollect(self):
+        gzFile = os.path.join(self.dir, 'image.fits.gz')
+        with gzip.open(gzFile, 'wb') as fid:
+            fid.write(b'image')
+        txtFile = os.path.join(self.dir, 'centroid.txt')
+        with open(txtFile, 'wb') as fid:
+            fid.write(b'centroid')
+
+        writes = [submitIO(collectFile, f, self.dstDir)
+                  for f in (gzFile, txtFile)]
+        dst = [write.result() for write in writes]
+        self.assertEqual([os.path.basename(f) for f in dst],
+                         ['image.fits', 'centroid.txt'])
+        self.assertEqual(readFile(dst[0]), b'image')
+        self.assertEqual(readFile(dst[1]), b'centroid')
+        self.assertEqual(sorted(os.listdir(self.dir)), ['iter0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
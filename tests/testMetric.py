@@ -0,0 +1,34 @@
+import unittest, os, tempfile
+import numpy as np
+from types import SimpleNamespace
+from aosMetric import aosMetric, pssnFromZ
+
+
+class TestPSSNfromZ(unittest.TestCase):
+    """Test the quadratic PSSN model of getPSSNfromZ()."""
+
+    def testLargeAberration(self):
+        alpha = np.full(19, 0.03)
+        z = np.zeros((2, 19))
+        z[0, 0] = 0.01
+        z[1, 0] = 1.  # 1 um of z4 at 0.5 um
+        pssn = pssnFromZ(z, 0.5, alpha)
+        self.assertAlmostEqual(pssn[0], 1 - 0.03 * (2 * np.pi * 0.02)**2)
+        self.assertEqual(pssn[1], 1e-6)
+
+        metr = aosMetric.__new__(aosMetric)
+        metr.nField = 2
+        metr.w = np.array([0.5, 0.5])
+        metr.PSSNw = pssn[:, None]
+        fd, outFile = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metr.writePSSN(SimpleNamespace(band='u'), outFile, 0)
+        finally:
+            os.remove(outFile)
+        self.assertTrue(np.isfinite(metr.FWHMeff).all())
+        self.assertTrue(np.isfinite(metr.GQdm5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+from aosPool import aosPool, getShared
+
+
+def weightedSum(i):
+    return i, float(np.sum(getShared('grid')[i]) * getShared('scale'))
+
+
+class TestPool(unittest.TestCase):
+    """Test the aosPool class."""
+
+    def setUp(self):
+        self.grid = np.arange(60.).reshape(20, 3)
+        self.expected = [(i, np.sum(self.grid[i]) * 2) for i in range(20)]
+
+    def testWorkers(self):
+        with aosPool(3, arrays={'grid': self.grid},
+                     constants={'scale': 2}) as pool:
+            self.assertEqual(pool.map(weightedSum, range(20)), self.expected)
+            # the same workers take the next batch
+            self.assertEqual(pool.map(weightedSum, range(20), chunksize=7),
+                             self.expected)
+        self.assertEqual(pool.blocks, [])
+
+    def testSerial(self):
+        with aosPool(1, arrays={'grid': self.grid},
+                     constants={'scale': 2}) as pool:
+            self.assertEqual(pool.map(weightedSum, range(20)), self.expected)
+            self.assertFalse(getShared('grid').flags.writeable)
+        # a later pool in this process doesn't see them
+        self.assertRaises(KeyError, getShared, 'grid')
+        self.assertTrue(self.grid.flags.writeable)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+from scipy.interpolate import Rbf
+import aosSurfaceMap
+from aosSurfaceMap import RbfGridOperator, getRbfGridOperator
+from aosSurfaceMap import writeSurfaceMap, readSurfaceMap
+
+
+class TestRbfGridOperator(unittest.TestCase):
+    """Test the RbfGridOperator class."""
+
+    def setUp(self):
+        np.random.seed(0)
+        r = np.sqrt(np.random.uniform(0.3**2, 1, 300)) * 1000
+        t = np.random.uniform(0, 2 * np.pi, 300)
+        self.xf = r * np.cos(t)
+        self.yf = r * np.sin(t)
+        self.zf = 1e-4 * (np.sin(self.xf / 300) + np.cos(self.yf / 200))
+        self.op = RbfGridOperator(self.xf, self.yf, 300, 1000, 10, 10)
+
+    def testAgainstRbf(self):
+        z, dx, dy, dxdy = self.op.apply(self.zf)
+        Ff = Rbf(self.xf, self.yf, self.zf)
+        idx = self.op.idx
+        self.assertTrue(np.allclose(z[idx], Ff(self.op.xg, self.op.yg),
+                                    rtol=0, atol=1e-15))
+        self.assertTrue((z[~idx] == 0).all())
+
+        epsilon = 1e-3
+        fdx = (Ff(self.op.xg + epsilon, self.op.yg) -
+               Ff(self.op.xg - epsilon, self.op.yg)) / (2 * epsilon)
+        self.assertTrue(np.allclose(dx[idx], fdx, rtol=1e-5, atol=1e-13))
+
+    def testStack(self):
+        z = self.op.apply(self.zf)[0]
+        zz = self.op.apply(np.vstack((self.zf, 2 * self.zf)).T,
+                           blockSize=1000)[0]
+        self.assertTrue(np.allclose(zz[:, 0], z))
+        self.assertTrue(np.allclose(zz[:, 1], 2 * z))
+
+    def testIO(self):
+        fname = 'rbf.npz'
+        self.op.save(fname)
+        op2 = RbfGridOperator.load(fname)
+        os.remove(fname)
+        os.remove(fname.replace('.npz', '_lu.npy'))
+        self.assertEqual(self.op.key, op2.key)
+        self.assertTrue((self.op.apply(self.zf)[0] ==
+                         op2.apply(self.zf)[0]).all())
+
+    def testCache(self):
+        cacheDir = tempfile.mkdtemp()
+        maxRbfBytes = aosSurfaceMap.maxRbfBytes
+        # room for one operator's files on disk
+        aosSurfaceMap.maxRbfBytes = 1000000
+        try:
+            ops = [getRbfGridOperator(self.xf, self.yf, 300, 1000, n, n,
+                                      cacheDir=cacheDir)
+                   for n in (10, 11, 12, 13)]
+            storeDir = os.path.join(cacheDir, 'rbf')
+            self.assertEqual(os.listdir(storeDir), [ops[-1].key])
+            self.assertNotIn(ops[0].key, aosSurfaceMap._operators)
+            self.assertIs(getRbfGridOperator(self.xf, self.yf, 300, 1000,
+                                             13, 13, cacheDir=cacheDir),
+                          ops[-1])
+            self.assertFalse(ops[-1].lu.flags.writeable)
+        finally:
+            aosSurfaceMap.maxRbfBytes = maxRbfBytes
+            shutil.rmtree(cacheDir)
+
+
+class TestSurfaceMapIO(unittest.TestCase):
+    """Test writeSurfaceMap and readSurfaceMap."""
+
+    def testIO(self):
+        fname = 'surfacemap.txt'
+        data = np.random.randn(4, 36) * 1e-6
+        writeSurfaceMap(fname, *data, 6, 6, 1.5, 1.5, sidecar=True)
+
+        with open(fname) as fid:
+            lines = fid.readlines()
+        self.assertEqual(lines[0], '6 6 1.500000000E+00 1.500000000E+00\n')
+        self.assertEqual(lines[5], '%.9E %.9E %.9E %.9E\n' % tuple(data[:, 4]))
+
+        header, mm = readSurfaceMap(fname)
+        os.remove(fname.replace('.txt', '.npy'))
+        header, txt = readSurfaceMap(fname)
+        os.remove(fname)
+
+        self.assertEqual(header, (6, 6, 1.5, 1.5))
+        self.assertTrue((mm == data.T).all())
+        self.assertTrue(np.allclose(txt, data.T, rtol=1e-9, atol=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest, os, gzip, shutil, tempfile, time
+from aosWatcher import aosOutputWatcher
+from aosIO import readFile
+
+
+class TestOutputWatcher(unittest.TestCase):
+    """Test claiming files with aosOutputWatcher."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def watch(self, pattern, callback):
+        # the watcher thread doesn't poll within the test, the test does
+        return aosOutputWatcher([os.path.join(self.dir, pattern)], callback,
+                                interval=3600)
+
+    def write(self, name, text, age=0):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as fid:
+            fid.write(text)
+        if age:
+            t = time.time() - age
+            os.utime(path, (t, t))
+
+    def testClaim(self):
+        seen = []
+        watcher = self.watch('opd_*', lambda path: seen.append(
+            os.path.basename(path)))
+        self.write('opd_1', 'done', age=7200)
+        self.write('opd_2', 'recent')
+        self.write('wfs_1', 'not watched', age=7200)
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual(seen, [])
+        # complete files are claimed before finish(), after two stable polls
+        # and once their mtime is one interval old
+        watcher.poll()
+        self.assertEqual(seen, ['opd_1'])
+        claimed = watcher.finish()
+        self.assertEqual(seen, ['opd_1', 'opd_2'])
+        self.assertEqual([os.path.basename(p) for p in claimed], seen)
+
+    def testTruncated(self):
+        seen = []
+        watcher = self.watch('*.gz', lambda path: seen.append(readFile(path)))
+        data = gzip.compress(b'image' * 1000)
+        gzFile = os.path.join(self.dir, 'opd_1.fits.gz')
+        with open(gzFile, 'wb') as fid:
+            fid.write(data[:len(data) // 2])
+        watcher.poll()
+        watcher.poll()
+        # PhoSim is still writing it
+        self.assertEqual(seen, [])
+        with open(gzFile, 'ab') as fid:
+            fid.write(data[len(data) // 2:])
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual(seen, [b'image' * 1000])
+        self.assertEqual(watcher.finish(), [gzFile])
+
+    def testError(self):
+        def fail(path):
+            raise ValueError(path)
+        watcher = self.watch('*', fail)
+        self.write('opd_1', 'done')
+        self.assertRaises(ValueError, watcher.finish)
+
+
+if __name__ == '__main__':
+    unittest.main()